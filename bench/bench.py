@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+'''Time darkdraw drawing, cursor queries, editing, loading and saving, headless.
+
+    python3 bench/bench.py [-o bench_output.txt] [--baseline FILE] [--scale N] [-k SUBSTRING]
+
+Each result is written to the output as one line of JSON:
+    {"case": "frames", "bench": "draw", "seconds": 0.0123, "repeat": 5, "nrows": 5550}
+where seconds is the fastest of *repeat* runs.
+
+Cases are synthetic drawings (see CASES below) and samples/*.ddw.
+Pass --font to time png/gif export with a real font, as the default font may not be installed.
+To catch regressions, keep the output of a known-good run and compare against it:
+    python3 bench/bench.py -o baseline.txt
+    python3 bench/bench.py --baseline baseline.txt
+which exits with status 1 if any benchmark is slower than the baseline by more than --tolerance.
+'''
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from visidata import vd, Path, CharBox
+
+import darkdraw
+from darkdraw import DrawingSheet
+
+
+W, H = 200, 60  # canvas size of synthetic drawings
+
+colors256 = [str(i) for i in range(256)]
+wide = '日本語中文字漢字한국어🙂🎨🐍'
+narrow = 'abcdefghijklmnopqrstuvwxyz0123456789─│┌┐└┘├┤┬┴┼░▒▓█'
+
+
+def element(rnd, chars=narrow, color='', **kwargs):
+    n = rnd.randint(1, 5)
+    return dict(x=rnd.randrange(W), y=rnd.randrange(H), text=''.join(rnd.choice(chars) for i in range(n)),
+                color=color, tags=[], group='', **kwargs)
+
+
+def gen_elements(rnd, n):
+    'Return rows of *n* elements in the base frame.'
+    return [element(rnd) for i in range(n)]
+
+
+def gen_frames(rnd, nframes, n, nbase=0):
+    'Return rows of *nframes* frames with *n* elements each, over *nbase* base elements.'
+    rows = [dict(type='frame', id=str(i), x=0, y=0, tags=[], duration_ms=100) for i in range(nframes)]
+    rows += gen_elements(rnd, nbase)
+    for i in range(nframes):
+        rows += [element(rnd, frame=str(i)) for j in range(n)]
+    return rows
+
+
+def gen_groups(rnd, ngroups, nrefs, n=20):
+    'Return rows of *ngroups* groups of *n* elements, each placed *nrefs* times by reference.'
+    rows = []
+    for i in range(ngroups):
+        gid = f'g{i}'
+        subrows = [dict(element(rnd), x=rnd.randrange(10), y=rnd.randrange(5), group=gid) for j in range(n)]
+        rows.append(dict(type='group', id=gid, x=rnd.randrange(W), y=rnd.randrange(H), text='', color='', tags=[], group='', frame='none', rows=subrows))
+        for j in range(nrefs):
+            rows.append(dict(type='ref', ref=gid, x=rnd.randrange(W), y=rnd.randrange(H), text='', color='', tags=[], group=''))
+    return rows
+
+
+def gen_wide(rnd, n):
+    'Return rows of *n* elements of mostly double-width glyphs.'
+    return [element(rnd, wide) for i in range(n)]
+
+
+def gen_colors(rnd, n):
+    'Return rows of *n* elements each with a random color, background and attribute.'
+    return [element(rnd, color=f'{rnd.choice(["", "bold ", "underline "])}{rnd.choice(colors256)} on {rnd.choice(colors256)}') for i in range(n)]
+
+
+CASES = {
+    # name: (generator, args before scaling)
+    'elements': (gen_elements, [5000]),
+    'frames': (gen_frames, [50, 100, 500]),
+    'groups': (gen_groups, [20, 10]),
+    'wide': (gen_wide, [3000]),
+    'colors': (gen_colors, [5000]),
+}
+
+
+class HeadlessScreen:
+    'Minimal curses window that discards everything drawn on it.'
+    def __init__(self, h=50, w=160):
+        self.h, self.w = h, w
+    def __bool__(self): return True
+    def getmaxyx(self): return self.h, self.w
+    def addstr(self, *args): pass
+    def erase(self): pass
+    def bkgd(self, *args): pass
+    def move(self, y, x): pass
+    def clrtoeol(self): pass
+    def refresh(self): pass
+
+
+def write_ddw(rows, fn):
+    with open(fn, 'w') as fp:
+        for r in rows:
+            fp.write(json.dumps(r) + '\n')
+
+
+def load(fn):
+    vs = DrawingSheet(os.path.basename(fn), source=Path(fn))
+    vs.ensureLoaded()
+    vd.sync()
+    return vs
+
+
+def best(func, setup=lambda: None, repeat=5):
+    'Return fastest time in seconds of *repeat* calls of func(setup()).'
+    times = []
+    for i in range(repeat):
+        arg = setup()
+        t0 = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def benchmarks(fn, outdir):
+    'Generate (name, func, setup, repeat) for each benchmark of the drawing in *fn*.'
+    def fresh():
+        vs = load(fn)
+        dwg = vs.drawing
+        dwg.cursorBox = CharBox(None, W//2, H//2, 1, 1)
+        return dwg
+
+    def drawn():
+        dwg = fresh()
+        dwg.draw(HeadlessScreen())
+        return dwg
+
+    def redraw(dwg):
+        dwg.redraw_all()
+        dwg.draw(HeadlessScreen())
+
+    def move_and_draw(dwg):
+        scr = HeadlessScreen()
+        for i in range(20):
+            dwg.cursorBox.x1 += 1
+            dwg.draw(scr)
+
+    def draw_frames(dwg):
+        scr = HeadlessScreen()
+        for i in range(dwg.nFrames):
+            dwg.cursorFrameIndex = i
+            dwg.draw(scr)
+
+    def cursor_queries(dwg):
+        rnd = random.Random(0)
+        for i in range(200):
+            dwg.cursorBox = CharBox(None, rnd.randrange(W), rnd.randrange(H), 1, 1)
+            dwg.cursorRows
+            dwg.topCursorRows
+
+    def iterbox_frames(dwg):
+        dwg.iterbox(CharBox(None, 0, 0, W//2, H//2), frames=[dwg.currentFrame])
+
+    def clipboard(dwg):
+        return [r for r in dwg.source.rows if not r.type][:30]
+
+    def fill_chars(dwg):
+        dwg.fill_chars(clipboard(dwg), CharBox(None, 10, 10, 40, 20))
+
+    def paste_chars(dwg):
+        for i in range(10):
+            dwg.paste_chars(clipboard(dwg), CharBox(None, 10+i*5, 10, 1, 1))
+
+    def new_between_frame(dwg):
+        for i in range(min(dwg.nFrames-1, 10)):
+            dwg.source.new_between_frame(i, i+1)
+
+    yield 'load', lambda f: load(f), lambda: fn, 3
+    yield 'draw', redraw, drawn, 5
+    yield 'draw_cursor_moves', move_and_draw, drawn, 3
+    dwg = fresh()
+    if dwg.nFrames:
+        yield 'draw_frames', draw_frames, drawn, 3
+        yield 'new_between_frame', new_between_frame, fresh, 3
+    yield 'cursor_queries', cursor_queries, drawn, 3
+    yield 'iterbox_frames', iterbox_frames, drawn, 5
+    if clipboard(dwg):  # fill/paste of top-level elements only; refs have no width to fill with
+        yield 'fill_chars', fill_chars, drawn, 3
+        yield 'paste_chars', paste_chars, drawn, 3
+
+    def saver(ext):
+        def save(vs):
+            p = Path(os.path.join(outdir, 'out.' + ext))
+            if ext == 'txt':
+                vs.save_txt(p, vs)
+            else:
+                getattr(vd, 'save_' + ext)(p, vs)
+        return save
+
+    for ext in ['txt', 'ans', 'ansihtml', 'png', 'gif']:
+        yield 'save_' + ext, saver(ext), lambda: load(fn), 3
+
+
+def compare(results, baseline, tolerance):
+    'Print each result against *baseline* results; return list of the ones slower by more than *tolerance* times.'
+    old = {(r['case'], r['bench']): r['seconds'] for r in baseline}
+    slower = []
+    for r in results:
+        was = old.get((r['case'], r['bench']))
+        if not was:
+            continue
+        ratio = r['seconds'] / was
+        flag = ''
+        if ratio > tolerance:
+            slower.append(r)
+            flag = '  SLOWER'
+        print(f"{r['case']:>20} {r['bench']:<20} {was:9.4f}s -> {r['seconds']:9.4f}s  x{ratio:.2f}{flag}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark darkdraw headless')
+    parser.add_argument('-o', '--output', default='bench_output.txt', help='file to write results to, one JSON object per line')
+    parser.add_argument('--baseline', help='results from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown from baseline to report as regression')
+    parser.add_argument('--scale', type=float, default=1, help='multiply synthetic drawing sizes by this')
+    parser.add_argument('-k', dest='only', default='', help='run only benchmarks with this substring in "case/bench"')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--font', help='font file for save_png and save_gif (options.darkdraw_font)')
+    args = parser.parse_args()
+
+    vd.options.undo = False
+    if args.font:
+        vd.options.darkdraw_font = args.font
+    outdir = tempfile.mkdtemp(prefix='darkdraw-bench-')
+    samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples', '*.ddw')
+
+    cases = {}
+    for name, (gen, genargs) in CASES.items():
+        fn = os.path.join(outdir, name + '.ddw')
+        write_ddw(gen(random.Random(args.seed), *[max(1, int(a*args.scale)) for a in genargs]), fn)
+        cases[name] = fn
+    for fn in sorted(glob.glob(samples)):
+        cases['samples/' + os.path.basename(fn)[:-4]] = fn
+
+    results = []
+    with open(args.output, 'w') as out:
+        for case, fn in cases.items():
+            nrows = len(load(fn).rows)
+            for bench, func, setup, repeat in benchmarks(fn, outdir):
+                if args.only not in f'{case}/{bench}':
+                    continue
+                try:
+                    secs = best(func, setup, repeat)
+                except Exception as e:
+                    print(f'{case}/{bench}: {type(e).__name__}: {e}', file=sys.stderr)
+                    continue
+                r = dict(case=case, bench=bench, seconds=round(secs, 6), repeat=repeat, nrows=nrows)
+                results.append(r)
+                out.write(json.dumps(r) + '\n')
+                out.flush()
+                if not args.baseline:
+                    print(f'{case:>20} {bench:<20} {secs:9.4f}s')
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = [json.loads(line) for line in fp if line.strip()]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ from .save_ans import *
 from .load_dur import *
 from .boxdraw import *
 from .flip import *
+from .drawstats import *
 
 from .loader_scr import *  # deprecated 2020 format, remove anytime
 
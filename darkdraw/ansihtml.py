@@ -1,11 +1,15 @@
-from unittest import mock
 from visidata import AttrDict, VisiData, colors, vd, dispwidth
 from importlib import resources as importlib_resources
 import curses
+import html
+import json
 
 from .drawing import Drawing, DrawingSheet
+from .cellindex import CellView
+from .framebuf import FrameBuffer
 
 vd.option('darkdraw_html_tmpl', '', 'filename of HTML template to use for ansihtml saver')
+vd.option('darkdraw_html_animate', True, 'save_ansihtml saves drawings with frames as an animation, instead of the current frame only')
 
 
 def split_colorstr(colorstr):
@@ -76,14 +80,6 @@ def termcolor_to_css_color(n):
     r,g,b = xterm256_to_rgb(n)
     return '#%02x%02x%02x' % (r,g,b)
 
-def htmlattrstr(r, attrnames, **kwargs):
-    d = AttrDict(kwargs)
-    for a in attrnames:
-        if a in r:
-            d[a] = r[a]
-    return ' '.join('%s="%s"' % (k,v) for k, v in d.items() if v)
-
-
 def colorstr_to_style(color):
     fg, bg, attrs = split_colorstr(color)
 
@@ -108,37 +104,165 @@ def colorstr_to_style(color):
         ret['class'] = ' '.join(classes)
     return ret
 
-def iterline(dwg, y):
-    leftover = 0
-    minX, minY = dwg.minXY
-    maxX, maxY = dwg.maxXY
-    for x in range(minX, maxX+1):
-#        if leftover:
-#            leftover -= 1
-#            continue
-
-        rows = dwg._displayedRows.get((x,y), None)
-        if not rows:
-            yield x, ' ', AttrDict()
-        else:
-            for i in range(len(rows)):
-                r = rows[-i-1]
-                if dispwidth(r.text) > x-r.x:
-                    break
-            if len(r.text) > x-r.x:
-                ch = r.text[x-r.x]
-                yield x, ch, r
-                leftover = dispwidth(ch) - 1
-            else:
-                yield x, ' ', AttrDict()
+def colorstr_to_css(color):
+    'Return CSS declarations for *color* string.'
+    d = colorstr_to_style(color)
+    css = d['style']
+    for c in d.get('class', '').split():
+        css += dict(bold='font-weight: bold; ', underline='text-decoration: underline; ')[c]
+    return css
+
+
+class StyleSheet:
+    'CSS class names generated for color strings, one class per distinct color.'
+    def __init__(self):
+        self.classes = {}  # color string -> class name
 
+    def index(self, color):
+        'Return number of the class for *color*, adding it if new.'
+        c = self.classes.get(color)
+        if c is None:
+            c = self.classes[color] = len(self.classes)
+        return c
 
-def matches(a, b, attrs):
-    return all(a.get(attr) == b.get(attr) for attr in attrs)
+    def classname(self, color):
+        return f'c{self.index(color)}'
+
+    def css(self):
+        return ''.join(f'.c{c} {{ {colorstr_to_css(color)}}}\n' for color, c in self.classes.items())
+
+
+def linkrows(dwg, frame=None):
+    'Return dict of (x,y) -> topmost visible row with any of id, class, href, or title.'
+    ret = {}
+    view = CellView(dwg.source, frame or AttrDict(), dwg.disabled_tags)
+    for p in dwg.source.cellIndex.iterframe(frame):
+        if view.visible(p):
+            r = p.toprow if any(p.toprow.get(a) for a in 'id class href title'.split()) else None
+            for i in range(dispwidth(p.row.text)):
+                ret[(p.x+i, p.y)] = r
+    return {xy:r for xy, r in ret.items() if r}
+
+
+def iterspans(grid, links, y):
+    'Generate (x, text, color, link) for line *y* of *grid*, from its left edge: runs of cells with the same color and link row, and gaps between them as blanks with color "".'
+    x = grid.x1
+    for rx, glyphs, color in grid.runs(y):
+        if rx > x:
+            yield x, ' '*(rx-x), '', None
+        x = rx+len(glyphs)
+        if not links:
+            yield rx, ''.join(glyphs), color, None
+            continue
+
+        start = 0
+        link = links.get((rx, y))
+        for i in range(1, len(glyphs)+1):
+            nextlink = links.get((rx+i, y)) if i < len(glyphs) else None
+            if i == len(glyphs) or nextlink is not link:
+                yield rx+start, ''.join(glyphs[start:i]), color, link
+                start, link = i, nextlink
+
+
+def htmlattrs(r, attrnames, **kwargs):
+    'Return attribute string for HTML element from attrnames of row *r* and kwargs, escaped and skipping empty values.'
+    d = dict(kwargs)
+    for a in attrnames:
+        if r.get(a):
+            d[a] = r[a]
+    return ''.join(f' {k}="{html.escape(str(v))}"' for k, v in d.items() if v)
+
+
+def htmlspan(text, color, link, styles):
+    'Return HTML for *text* with *color* and *link* row; plain text if neither.'
+    text = html.escape(text, quote=False)
+    link = link or {}
+    classes = ' '.join(c for c in [styles.classname(color) if color else '', link.get('class')] if c)
+    spanattrs = htmlattrs(link, ['id'], **{'class': classes})
+    if spanattrs:
+        text = f'<span{spanattrs}>{text}</span>'
+    if link.get('href'):
+        text = f'<a{htmlattrs(link, ["href", "title"])}>{text}</a>'
+    return text
+
+
+def iterhtml(grid, links, styles):
+    'Generate HTML for each line of *grid*, without trailing blanks.'
+    for y in range(grid.y1, grid.y1+grid.h):
+        yield ''.join(htmlspan(text, color, link, styles) for x, text, color, link in iterspans(grid, links, y)) + '\n'
+
+
+# ddwplay(pre, anim) fills the empty <pre> with the cells of anim.base, then applies anim.frames[i] after anim.durations[i-1] ms, cycling.
+# Each run is [y, x, class number or -1, glyphs]; glyphs is a string, with \0 for the right half of a wide glyph, or a list of strings.
+player_js = r'''
+function ddwplay(pre, anim) {
+  const lines = [], cells = [];
+  for (let y = 0; y < anim.h; y++) {
+    lines.push(pre.appendChild(document.createElement('span')));
+    pre.appendChild(document.createTextNode('\n'));
+    cells.push(Array.from({length: anim.w}, () => [' ', -1]));
+  }
+  function apply(runs) {
+    const dirty = new Set();
+    for (const [y, x, c, glyphs] of runs) {
+      (Array.isArray(glyphs) ? glyphs : Array.from(glyphs)).forEach((g, i) => cells[y][x+i] = [g == '\0' ? '' : g, c]);
+      dirty.add(y);
+    }
+    for (const y of dirty) {
+      const spans = [];
+      for (const [g, c] of cells[y]) {
+        if (!spans.length || spans[spans.length-1][1] != c) spans.push(['', c]);
+        spans[spans.length-1][0] += g;
+      }
+      lines[y].replaceChildren(...spans.map(([text, c]) => {
+        const span = document.createElement('span');
+        if (c >= 0) span.className = 'c' + c;
+        span.textContent = text;
+        return span;
+      }));
+    }
+  }
+  let i = 0;
+  function step() {
+    i = (i+1) % anim.frames.length;
+    apply(anim.frames[i]);
+    setTimeout(step, anim.durations[i]);
+  }
+  apply(anim.base);
+  if (anim.frames.length > 1) setTimeout(step, anim.durations[0]);
+}
+'''
+
+
+def deltaruns(grid, prev, x1, y1, styles):
+    'Return list of [y, x, class number, glyphs] for the cells of FrameBuffer *grid* that differ from *prev*, relative to (x1,y1), for ddwplay().'
+    ret = []
+    for y, x, glyphs, color in grid.delta(prev):
+        glyphs = [g or '\0' for g in glyphs]
+        if all(len(g) == 1 for g in glyphs):
+            glyphs = ''.join(glyphs)
+        ret.append([y-y1, x-x1, styles.index(color) if color else -1, glyphs])
+    return ret
+
+
+def animation_html(grids, durations, styles):
+    'Return HTML for an animation of FrameBuffers *grids*: an empty <pre> and a script calling ddwplay() with the first frame in full and each frame after as a delta from the one before.'
+    bufs = [g for g in grids if g]
+    x1 = min(g.x1 for g in bufs)
+    y1 = min(g.y1 for g in bufs)
+    anim = dict(w=max(g.x1+g.w for g in bufs)-x1,
+                h=max(g.y1+g.h for g in bufs)-y1,
+                base=deltaruns(grids[0], FrameBuffer(), x1, y1, styles),
+                frames=[deltaruns(grid, prev, x1, y1, styles) for prev, grid in zip(grids[-1:]+grids, grids)],  # frames[0] is from last frame back to first
+                durations=durations)
+    js = json.dumps(anim, separators=(',', ':'), ensure_ascii=False).replace('</', '<\\/')
+    return f'<pre></pre><script>ddwplay(document.currentScript.previousElementSibling, {js})</script>\n'
 
 
 @VisiData.api
 def save_ansihtml(vd, p, *sheets):
+    styles = StyleSheet()
+    body = []
     for vs in sheets:
         if isinstance(vs, DrawingSheet):
             dwg = Drawing('', source=vs)
@@ -147,51 +271,37 @@ def save_ansihtml(vd, p, *sheets):
         else:
             vd.fail(f'{vs.name} not a drawing')
 
-        dwg._scr = mock.MagicMock(__bool__=mock.Mock(return_value=True),
-                                  getmaxyx=mock.Mock(return_value=(9999, 9999)))
-        dwg.reload()
-        dwg.draw(dwg._scr)
-        body = '''<pre>'''
-
-        minX, minY = dwg.minXY
-        maxX, maxY = dwg.maxXY
-        for y in range(minY, maxY+1):
-            line = ''
-            text = ''
-            lastrow = AttrDict()
-            for x, ch, r in iterline(dwg, y):
-                divch = f'<div>{ch}</div>'
-                if matches(r, lastrow, 'color id class href title'.split()):
-                    text += divch
-                    continue
-
-                if text:
-                    kwargs = colorstr_to_style(lastrow.color)
-
-                    spanattrstr = htmlattrstr(lastrow, 'id class'.split(), **kwargs)
-                    span = f'<span {spanattrstr}>{text}</span>'
-                    if lastrow.href:
-                        linkattrstr = htmlattrstr(lastrow, 'href title'.split())
-                        span = f'<a {linkattrstr}>{span}</a>'
-
-                    line += span
-
-                text = divch
-                lastrow = r
-
-            body += f'<div>{line}</div>\n'
-        body += '</pre>\n'
+        dwg.source.ensureLoaded()
+        frames = dwg.source.frames
+        grids = [dwg.render_grid(f) for f in frames]
+        if any(grids) and vs.options.darkdraw_html_animate:
+            script = f'<script>{player_js}</script>\n'
+            if script not in body:
+                body.append(script)
+            body.append(animation_html(grids, [(f.duration_ms or 100) for f in frames], styles))
+            continue
+
+        grid = dwg.render_grid(dwg.currentFrame)
+        links = linkrows(dwg, dwg.currentFrame)
+
+        body.append('<pre>')
+        body.extend(iterhtml(grid, links, styles))
+        body.append('</pre>\n')
 
+    body = ''.join(body)
+    style = f'<style>\n{styles.css()}</style>\n'
     try:
-        fn = vs.options.darkdraw_html_tmpl
+        fn = sheets[0].options.darkdraw_html_tmpl
         if fn:
             tmpl = open(fn).read()
         else:
             tmpl = importlib_resources.files('darkdraw').joinpath('ansi.html').read_bytes().decode()
-        out = tmpl.replace('$body$', body)
+        if '$style$' not in tmpl:  # older templates: stylesheet goes with the body
+            body = style + body
+        out = tmpl.replace('$style$', style).replace('$body$', body)
     except FileNotFoundError as e:
         vd.exceptionCaught(e)
-        out = body
+        out = style + body
 
     with p.open_text(mode='w') as fp:
         fp.write(out)
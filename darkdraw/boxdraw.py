@@ -23,22 +23,27 @@ def set_box_chars(sheet):
 def box_cursor(sheet):
     horiz, vert, tl, tr, bl, br = vd.box_chars
     box = sheet.cursorBox
+    color = vd.default_color
 
     # Corners
-    sheet.add_text(tl, box.x1, box.y1, vd.default_color)
-    sheet.add_text(tr, box.x2-2, box.y1, vd.default_color)
-    sheet.add_text(bl, box.x1, box.y2-2, vd.default_color)
-    sheet.add_text(br, box.x2-2, box.y2-2, vd.default_color)
+    rows = [
+        sheet.text_row(tl, box.x1, box.y1, color),
+        sheet.text_row(tr, box.x2-2, box.y1, color),
+        sheet.text_row(bl, box.x1, box.y2-2, color),
+        sheet.text_row(br, box.x2-2, box.y2-2, color),
+    ]
 
     # Horizontal edges
     for x in range(box.x1 + 1, box.x2 - 2):
-        sheet.add_text(horiz, x, box.y1, vd.default_color)
-        sheet.add_text(horiz, x, box.y2-2, vd.default_color)
+        rows.append(sheet.text_row(horiz, x, box.y1, color))
+        rows.append(sheet.text_row(horiz, x, box.y2-2, color))
 
     # Vertical edges
     for y in range(box.y1 + 1, box.y2 - 2):
-        sheet.add_text(vert, box.x1, y, vd.default_color)
-        sheet.add_text(vert, box.x2-2, y, vd.default_color)
+        rows.append(sheet.text_row(vert, box.x1, y, color))
+        rows.append(sheet.text_row(vert, box.x2-2, y, color))
+
+    sheet.source.addRows(rows)
 
 
 Drawing.addCommand('', 'set-box-chars', 'sheet.set_box_chars()', 'set characters for drawing boxes (format: horiz vert tl tr bl br)')
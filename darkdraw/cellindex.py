@@ -0,0 +1,277 @@
+import bisect
+import functools
+from collections import namedtuple
+
+from visidata import dispwidth
+
+
+# one element as placed on the canvas; sorted by (seq, sub) == drawing order
+# .frames is None for base elements, else the set of frame ids the element is in
+Placement = namedtuple('Placement', 'seq sub toprow row x y frames')
+
+TILE_SIZE = 32  # width and height of tile buckets, in cells
+BASE = ''  # frame key for elements without a frame
+
+
+@functools.lru_cache(maxsize=None)
+def frameset(framestr):
+    'Return frozenset of frame ids in space-separated *framestr*.'
+    return frozenset(framestr.split())
+
+
+def framekeys(framestr):
+    return frameset(framestr) if framestr else (BASE,)
+
+
+def any_match(G1, G2):
+    if G1 and G2:
+        for g in G1:
+            if g in G2: return True
+
+
+class CellIndex:
+    'Persistent (x,y) -> stack of placed elements for a DrawingSheet, kept up to date as rows are added, removed, or changed.'
+    def __init__(self, sheet):
+        self.sheet = sheet
+        self.epoch = 0
+        self.clear()
+
+    def clear(self):
+        self.epoch += 1    # bumped whenever the index is rebuilt from scratch
+        self.rows = None   # sheet.rows list this index was built from; rebuild if sheet.rows is replaced
+        self.cells = {}    # (x,y) -> list of Placement, bottom first
+        self.tiles = {}    # (frameid, x//TILE_SIZE, y//TILE_SIZE) -> {(seq, sub): Placement} of text elements touching that tile
+        self.framerows = {}  # frameid -> {seq: toprow} of non-frame rows in that frame (BASE for no frame)
+        self.tags = {}     # tag -> {id(row): row} of elements with that tag (empty tags kept for stable ordering)
+        self.placed = {}   # id(toprow) -> list of (Placement, [(x,y), ...])
+        self.seqs = {}     # id(toprow) -> seq (fractional if inserted between other rows)
+        self.nextseq = 0
+        self.groupmap = None  # group id -> group row, computed on demand
+        self.changed = None   # set of (x,y) changed since last taken by a Drawing; None if everything changed
+        self.flats = {}    # group id -> (group, group.rows, len(group.rows), [(row, dx, dy, parents), ...])
+        self.byframe = {}  # frameid -> {(seq, sub): Placement} of text elements in that frame (BASE for no frame)
+        self.framegens = {}  # frameid -> count of changes to elements in that frame
+
+    @property
+    def stale(self):
+        return self.rows is not self.sheet.rows
+
+    def invalidate(self):
+        self.rows = None
+        self.groupmap = None
+        self.flats.clear()
+
+    def rebuild(self):
+        self.clear()
+        self.rows = self.sheet.rows
+        for r in self.rows:
+            self.add(r)
+
+    def add(self, toprow):
+        'Index *toprow* on top of everything already indexed.'
+        seq = self.nextseq
+        self.nextseq += 1
+        self.insert(toprow, seq)
+
+    def insert(self, toprow, seq):
+        'Index *toprow* at depth *seq*, which may be between the seqs of already indexed rows.'
+        self.seqs[id(toprow)] = seq
+        self._place(toprow, seq)
+
+    def remove(self, toprow):
+        self.seqs.pop(id(toprow), None)
+        self._unplace(toprow)
+
+    def update(self, toprow):
+        'Reindex *toprow* at its existing depth after it has been moved or changed.'
+        if toprow.type == 'group':  # refs to this group are affected too
+            self.invalidate()
+            return
+
+        seq = self.seqs.get(id(toprow))
+        if seq is None:
+            return
+        self._unplace(toprow)
+        self._place(toprow, seq)
+
+    def _place(self, toprow, seq):
+        if toprow.type == 'frame':
+            return
+
+        if toprow.type == 'group' and self.groupmap is not None and self.groupmap.get(toprow.id) is not toprow:
+            self.groupmap = None
+
+        fids = framekeys(toprow.frame)
+        for fid in fids:
+            self.framerows.setdefault(fid, {})[seq] = toprow
+
+        placements = []
+        for sub, (r, x, y, parents) in enumerate(self.sheet.iterdeep([toprow])):
+            p = Placement(seq, sub, toprow, r, x, y, frameset(r.frame) if r.frame else None)
+            for tag in (r.tags or []):
+                self.tags.setdefault(tag, {})[id(r)] = r
+
+            xys = [(x+i, y) for i in range(dispwidth(r.text or ''))]
+            if self.changed is not None:
+                self.changed.update(xys)
+            for xy in xys:
+                bisect.insort(self.cells.setdefault(xy, []), p)
+            for tile in self._tiles(p, xys):
+                self.tiles.setdefault(tile, {})[p[:2]] = p
+            if xys:
+                for fid in self._fids(p):
+                    self.byframe.setdefault(fid, {})[p[:2]] = p
+                    self.framegens[fid] = self.framegens.get(fid, 0) + 1
+            placements.append((p, xys))
+
+        self.placed[id(toprow)] = (seq, fids, placements)
+
+    def _unplace(self, toprow):
+        if toprow.type == 'group':
+            self.groupmap = None
+
+        seq, fids, placements = self.placed.pop(id(toprow), (None, (), []))
+        for fid in fids:
+            del self.framerows[fid][seq]
+
+        for p, xys in placements:
+            for rows in self.tags.values():
+                rows.pop(id(p.row), None)
+
+            if self.changed is not None:
+                self.changed.update(xys)
+
+            for xy in xys:
+                stack = self.cells[xy]
+                del stack[bisect.bisect_left(stack, p)]
+                if not stack:
+                    del self.cells[xy]
+
+            for tile in self._tiles(p, xys):
+                bucket = self.tiles[tile]
+                del bucket[p[:2]]
+                if not bucket:
+                    del self.tiles[tile]
+
+            if xys:
+                for fid in self._fids(p):
+                    del self.byframe[fid][p[:2]]
+                    self.framegens[fid] += 1
+
+    def _fids(self, p):
+        return p.frames if p.frames is not None else (BASE,)
+
+    def _tiles(self, p, xys):
+        if not xys:
+            return ()
+        (x1, y), (x2, _) = xys[0], xys[-1]
+        ty = y//TILE_SIZE
+        return [(fid, tx, ty) for fid in self._fids(p)
+                              for tx in range(x1//TILE_SIZE, x2//TILE_SIZE+1)]
+
+    def iterwindow(self, x, y, w, h, frame=None):
+        'Generate Placements of text elements visible in *frame* (base only if None) in tiles overlapping the *w*x*h* window at (*x*,*y*), in drawing order.'
+        fids = [BASE]
+        if frame and frame.id:
+            fids.append(frame.id)
+
+        found = {}
+        for fid in fids:
+            for ty in range(y//TILE_SIZE, (y+h-1)//TILE_SIZE+1):
+                for tx in range(x//TILE_SIZE, (x+w-1)//TILE_SIZE+1):
+                    found.update(self.tiles.get((fid, tx, ty), {}))
+        for k in sorted(found):
+            yield found[k]
+
+    def inbox(self, x1, y1, x2, y2, fids=(), visible=lambda p: True):
+        'Return Placements of text elements in base or any frame in *fids* covering any cell with x1 <= x < x2 and y1 <= y < y2, for which *visible(p)*, in drawing order.'
+        if x1 >= x2 or y1 >= y2:
+            return []
+        fids = [BASE, *fids]
+        tx1, tx2, ty1, ty2 = x1//TILE_SIZE, (x2-1)//TILE_SIZE, y1//TILE_SIZE, (y2-1)//TILE_SIZE
+        if len(fids)*(tx2-tx1+1)*(ty2-ty1+1) > len(self.tiles):  # box larger than the drawing
+            keys = [k for k in self.tiles if k[0] in fids and tx1 <= k[1] <= tx2 and ty1 <= k[2] <= ty2]
+        else:
+            keys = [(fid, tx, ty) for fid in fids for ty in range(ty1, ty2+1) for tx in range(tx1, tx2+1)]
+
+        found = {}
+        for key in keys:
+            for k, p in self.tiles.get(key, {}).items():
+                if k not in found and y1 <= p.y < y2 and p.x < x2 and p.x+dispwidth(p.row.text) > x1 and visible(p):
+                    found[k] = p
+        return [found[k] for k in sorted(found)]
+
+    def iterframe(self, frame=None):
+        'Return Placements of all text elements visible in *frame* (base only if None), in drawing order.'
+        found = dict(self.byframe.get(BASE, {}))
+        if frame and frame.id:
+            found.update(self.byframe.get(frame.id, {}))
+        return [found[k] for k in sorted(found)]
+
+    def nframe(self, frame=None):
+        'Return number of Placements of text elements visible in *frame* (base only if None), as iterframe would return.'
+        base = self.byframe.get(BASE, {})
+        n = len(base)
+        if frame and frame.id:
+            n += sum(1 for k in self.byframe.get(frame.id, {}) if k not in base)
+        return n
+
+    def generation(self, frame=None):
+        'Return a key that changes whenever any element visible in *frame* is placed, moved, or removed.'
+        return (self.epoch, self.framegens.get(BASE, 0), self.framegens.get(frame.id, 0) if frame else 0)
+
+    def dirty(self, xys, visible):
+        'Return list of Placements with *visible(p)* covering any cell in the set *xys*, in drawing order.  Add all cells covered by those elements to *xys*.'
+        found = {}
+        todo = list(xys)
+        while todo:
+            for p in self.cells.get(todo.pop(), ()):
+                if p[:2] in found or not visible(p):
+                    continue
+                found[p[:2]] = p
+                for i in range(dispwidth(p.row.text)):
+                    xy = (p.x+i, p.y)
+                    if xy not in xys:
+                        xys.add(xy)
+                        todo.append(xy)
+
+        return [found[k] for k in sorted(found)]
+
+    def inframes(self, fids, base=True):
+        'Return rows in any of the frames with ids *fids* (and base rows if *base*), in drawing order.'
+        found = dict(self.framerows.get(BASE, {})) if base else {}
+        for fid in fids:
+            found.update(self.framerows.get(fid, {}))
+        return [found[k] for k in sorted(found)]
+
+
+class CellView:
+    'Read-only mapping of (x,y) -> list of visible toprows (topmost last) in *frame*, backed by the sheet cellIndex.'
+    def __init__(self, sheet, frame, disabled_tags=()):
+        self.sheet = sheet
+        self.frame = frame
+        self.disabled_tags = disabled_tags
+
+    def visible(self, p):
+        if any_match(p.row.tags, self.disabled_tags): return False
+        if p.frames is None: return True
+        return self.frame.id in p.frames
+
+    def get(self, xy, default=None):
+        ret = []
+        for p in self.sheet.cellIndex.cells.get(xy, ()):
+            if self.visible(p) and not any(p.toprow is r for r in ret):
+                ret.append(p.toprow)
+        return ret or default
+
+    def __getitem__(self, xy):
+        return self.get(xy, [])
+
+    def __contains__(self, xy):
+        return bool(self.get(xy))
+
+    def keys(self):
+        return [xy for xy in self.sheet.cellIndex.cells if xy in self]
+
+    def __iter__(self):
+        return iter(self.keys())
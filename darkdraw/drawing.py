@@ -1,15 +1,19 @@
 from unittest import mock
-from collections import defaultdict
+import bisect
 import itertools
 import functools
 from random import choice
 import time
 import unicodedata
+import curses
 from copy import copy, deepcopy
 from visidata import *
 from visidata import dispwidth, CharBox, boundingBox, asyncthread
 from visidata.bezier import bezier
 
+from .cellindex import CellIndex, CellView, any_match, frameset
+from .framebuf import composite, clip, colorattrs
+
 
 vd.allPrefixes += list('01')
 vd.option('pen_down', False, 'is pen down')
@@ -17,6 +21,9 @@ vd.option('disp_guide_xy', '', 'x y position of onscreen guides')
 vd.option('autosave_interval_s', 0, 'seconds between autosave')
 vd.option('autosave_path', 'autosave', 'path to put autosave files')
 vd.option('ddw_add_baseframe', False, 'add text to baseframe instead of current frame')
+vd.option('ddw_frame_cache_size', 0, 'number of composited frames to keep in memory for animation playback (0 for every frame of the drawing)')
+vd.option('ddw_frame_cache_mb', 256, 'megabytes of composited frames to keep in memory for animation playback')
+vd.option('darkdraw_txt_frames', '', 'frames save_txt saves: "" for the current frame, "all" for every frame one after another, padded to the same number of lines, or "files" for every frame in its own file numbered after the filename')
 
 #vd.charPalWidth = charPalWidth = 16
 #vd.charPalHeight = charPalHeight = 16
@@ -53,11 +60,6 @@ def random_word(vd):
     return 'unnamed'
 
 
-def any_match(G1, G2):
-    if G1 and G2:
-        for g in G1:
-            if g in G2: return True
-
 class FramesSheet(Sheet):
     rowtype='frames'  # rowdef: { .type, .id, .duration_ms, .x, .y }
     columns = [
@@ -68,26 +70,153 @@ class FramesSheet(Sheet):
         ItemColumn('y', type=int),
     ]
 
+class ElementColumn(ItemColumn):
+    'ItemColumn that keeps the cell index of its DrawingSheet in sync with edits.  Elements shared with other frames are copied first, so the edit applies to the current frame only.'
+    def putValue(self, row, val):
+        sheet = self.sheet
+        if self.expr != 'frame' and not isinstance(sheet.source, DrawingSheet):  # not rows nested within a group
+            tx = sheet.transaction()
+            if tx.shared(row):
+                with tx:
+                    tx.set(row, self.expr, val)
+                return
+        super().putValue(row, val)
+        sheet.reindex([row])
+
+
+def txtlines(grid):
+    'Generate lines of text of FrameBuffer *grid* from (0,0) to its bottom edge, built from the runs of occupied cells on each line, without trailing blanks.'
+    for y in range(grid.y1+grid.h):
+        parts = []
+        cx = 0
+        for x, glyphs, color in grid.runs(y):
+            end = x+len(glyphs)
+            clipped = clip(x, glyphs, 0, end)
+            if not clipped:
+                continue
+            x, text = clipped
+            parts.append(' '*(x-cx))
+            parts.append(text)
+            cx = end
+        yield ''.join(parts).rstrip(' ')
+
+
+def write_txt(fp, grid, nlines=0):
+    'Write FrameBuffer *grid* as text to *fp*; empty lines at the bottom are dropped, except to make *nlines* lines.'
+    n = 0       # lines written
+    blanks = 0  # empty lines not yet written
+    for line in txtlines(grid):
+        if not line:
+            blanks += 1
+            continue
+        fp.write('\n'*blanks + line + '\n')
+        n += blanks+1
+        blanks = 0
+    fp.write('\n'*(nlines-n))
+
+
+_missing = object()  # old value of an attribute that was not set
+
+
+class Transaction:
+    '''Attribute changes to many elements, undone together from one columnar record.  Use as context manager from Drawing.transaction().
+    Elements shared by *frameid* and other frames are copied on first edit, so the edit applies to *frameid* only.'''
+    def __init__(self, sheet, frameid=None):
+        self.sheet = sheet  # DrawingSheet the elements are on
+        self.frameid = frameid
+        self.changes = {}   # attr -> ([row, ...], [old value, ...])
+        self.copies = {}    # id(shared row) -> (shared row, its copy in frameid)
+
+    def shared(self, row):
+        'Return True if *row* is in frameid and also in other frames.'
+        if not self.frameid or not row.frame:
+            return False
+        fids = frameset(row.frame)
+        return self.frameid in fids and len(fids) > 1
+
+    def drop(self, row):
+        'Remove *row* from frameid only, if it is shared with other frames; return True if so.'
+        if not self.shared(row):
+            return False
+        self._set(row, 'frame', ' '.join(f for f in row.frame.split() if f != self.frameid))
+        return True
+
+    def own(self, row):
+        'Return *row*, or if it is shared with other frames, its copy in frameid only (made on first call).'
+        if id(row) in self.copies:
+            return self.copies[id(row)][1]
+        if not self.shared(row):
+            return row
+        newr = deepcopy(row)  # tags and group rows are lists, not to be shared either
+        newr.frame = self.frameid
+        self.copies[id(row)] = (row, newr)
+        self.drop(row)
+        return newr
+
+    def set(self, row, attr, value):
+        'Set *attr* of *row* (or its copy, if shared) to *value*, keeping the old value for undo.  Return the row changed.'
+        row = self.own(row)
+        self._set(row, attr, value)
+        return row
+
+    def _set(self, row, attr, value):
+        rows, oldvalues = self.changes.setdefault(attr, ([], []))
+        rows.append(row)
+        oldvalues.append(row.get(attr, _missing))
+        row[attr] = value
+
+    @property
+    def rows(self):
+        'Rows changed so far, each once.'
+        return list({id(r): r for rows, _ in self.changes.values() for r in rows}.values())
+
+    def undo(self):
+        for attr, (rows, oldvalues) in self.changes.items():
+            for r, v in zip(reversed(rows), reversed(oldvalues)):
+                if v is _missing:
+                    r.pop(attr, None)
+                else:
+                    r[attr] = v
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.copies:  # copies go just above the rows they were copied from
+            sheet = self.sheet
+            sheet.addRowsAfter({k: [newr] for k, (r, newr) in self.copies.items()})
+            selected = [(r, newr) for r, newr in self.copies.values() if sheet.isSelected(r)]
+            if selected:  # the originals are no longer in this frame; select their copies instead
+                sheet.addUndoSelection()
+                for r, newr in selected:
+                    sheet.unselectRow(r)
+                    sheet.selectRow(newr)
+        if self.changes:
+            vd.addUndo(self.undo)
+            self.sheet.setModified()
+            self.sheet.reindex(self.rows)
+
+
 class DrawingSheet(JsonSheet):
     rowtype='elements'  # rowdef: { .type, .x, .y, .text, .color, .group, .tags=[], .frame, .id, .rows=[] }
     columns=[
-        ItemColumn('id', type=str),
-        ItemColumn('type'),
-        ItemColumn('x', type=int),
-        ItemColumn('y', type=int),
+        ElementColumn('id', type=str),
+        ElementColumn('type'),
+        ElementColumn('x', type=int),
+        ElementColumn('y', type=int),
 
-        ItemColumn('text'),  # for text objects (type == '')
-        ItemColumn('color', type=str), # for text
+        ElementColumn('text'),  # for text objects (type == '')
+        ElementColumn('color', type=str), # for text
 
         # for all objects
-        ItemColumn('tags'),  # for all objs
-        ItemColumn('group'), # "
-        ItemColumn('frame', type=str), # "
+        ElementColumn('tags'),  # for all objs
+        ElementColumn('group'), # "
+        ElementColumn('frame', type=str), # "
 
-        ItemColumn('rows'), # for groups
-        ItemColumn('duration_ms', type=int), # for frames
+        ElementColumn('rows'), # for groups
+        ElementColumn('duration_ms', type=int), # for frames
 
-        ItemColumn('ref'),
+        ElementColumn('ref'),
     ]
     colorizers = [
         CellColorizer(3, None, lambda s,c,r,v: r and c and c.name == 'text' and r.color)
@@ -99,13 +228,167 @@ class DrawingSheet(JsonSheet):
     def drawing(self):
         return Drawing(self.name+".ddw", source=self)
 
-    def addRow(self, row, **kwargs):
-        assert not any(row is r for r in self.rows), 'duplicate row reference'  #61: remove when fixed
-        row = super().addRow(row, **kwargs)
+    def rowids(self):
+        'Return set of id() of all rows, rebuilt if rows were replaced or changed other than by addRow/addRows/commitDeleteRow.'
+        rows, ids = self._rowids
+        if rows is not self.rows or len(ids) != len(self.rows):
+            ids = set(map(id, self.rows))
+            self._rowids = (self.rows, ids)
+        return ids
+
+    def addRow(self, row, index=None):
+        ids = self.rowids()
+        assert id(row) not in ids, 'duplicate row reference'  #61: remove when fixed
+        row = super().addRow(row, index=index)
+        ids.add(id(row))
         vd.addUndo(self.rows.remove, row)
         self.setModified()
+
+        idx = self._cellIndex
+        if idx.stale or row.type == 'frame':
+            pass
+        elif index is None or index >= len(self.rows)-1:
+            idx.add(row)
+        else:
+            idx.invalidate()  # inserted below existing elements
         return row
 
+    def addRows(self, rows, index=None):
+        'Insert *rows* at *index*, or append at end of rows if *index* is None.  One undo for the batch.  Return list of added rows.'
+        ids = self.rowids()
+        added = []
+        for r in rows:
+            assert id(r) not in ids, 'duplicate row reference'  #61: remove when fixed
+            r = super().addRow(r, index=None if index is None else index+len(added))
+            ids.add(id(r))
+            added.append(r)
+
+        if not added:
+            return added
+
+        vd.addUndo(self._unaddRows, added)
+        self.setModified()
+
+        idx = self._cellIndex
+        if idx.stale:
+            pass
+        elif index is None or index+len(added) >= len(self.rows):
+            for r in added:
+                if r.type != 'frame':
+                    idx.add(r)
+        else:
+            idx.invalidate()  # inserted below existing elements
+        return added
+
+    def addRowsAfter(self, after):
+        'Insert new rows just after existing rows, in one pass, with one undo.  *after* maps id(row) to list of rows to insert after that row.  Return list of added rows.'
+        ids = self.rowids()
+        idx = self._cellIndex
+        seqs = {} if idx.stale else idx.seqs
+        newrows = []
+        added = []
+        runs = []  # [seq of row before, seq of row after, [rows inserted between]]
+        pending = []  # runs still waiting for the seq of the row after
+        for r in self.rows:
+            seq = seqs.get(id(r))
+            if seq is not None and pending:
+                for run in pending:
+                    run[1] = seq
+                pending = []
+            newrows.append(r)
+            inserted = after.get(id(r), ())
+            for newr in inserted:
+                assert id(newr) not in ids, 'duplicate row reference'  #61: remove when fixed
+                newrows.append(newr)
+                added.append(newr)
+            if inserted:
+                runs.append([seq, None, inserted])
+                pending.append(runs[-1])
+
+        if not added:
+            return added
+
+        self.rows[:] = newrows
+        ids.update(map(id, added))
+        vd.addUndo(self._unaddRows, added)
+        self.setModified()
+
+        if idx.stale:
+            return added
+
+        # index new rows between the rows around them, or reindex everything if there is no room
+        for lo, hi, inserted in runs:
+            hi = idx.nextseq if hi is None else hi
+            step = (hi-lo)/(len(inserted)+1) if lo is not None else 0
+            if lo is None or not (lo < lo+step and lo+step*len(inserted) < hi):
+                self.reindex()
+                break
+            for i, newr in enumerate(inserted):
+                idx.insert(newr, lo+step*(i+1))
+        return added
+
+    def _unaddRows(self, rows):
+        ids = set(map(id, rows))
+        self.rows[:] = [r for r in self.rows if id(r) not in ids]
+
+    def commitDeleteRow(self, row):
+        super().commitDeleteRow(row)
+        self._rowids[1].discard(id(row))
+        if not self._cellIndex.stale:
+            self._cellIndex.remove(row)
+
+    def deleteRows(self, rows):
+        'Remove *rows* (by identity) in one pass over all rows, with one undo.  Return number of rows removed.'
+        ids = set(map(id, rows))
+        kept = []
+        removed = []
+        where = []  # index in rows before removal of each removed row
+        for i, r in enumerate(self.rows):
+            if id(r) in ids:
+                removed.append(r)
+                where.append(i)
+            else:
+                kept.append(r)
+
+        if not removed:
+            return 0
+
+        self.cursorRowIndex -= bisect.bisect_left(where, self.cursorRowIndex)
+        self.rows[:] = kept  # keep the same list, so the index and other references stay valid
+        for r in removed:
+            self.commitDeleteRow(r)
+
+        vd.addUndo(self._undeleteRows, removed, where)
+        self.setModified()
+        return len(removed)
+
+    def _undeleteRows(self, rows, where):
+        oldrows = iter(self.rows)
+        newrows = []
+        for r, i in zip(rows, where):
+            newrows.extend(itertools.islice(oldrows, i-len(newrows)))
+            newrows.append(r)
+        newrows.extend(oldrows)
+        self.rows[:] = newrows
+
+    @property
+    def cellIndex(self):
+        'Spatial index of all elements, rebuilt if stale.'
+        if self._cellIndex.stale:
+            self._cellIndex.rebuild()
+        return self._cellIndex
+
+    def reindex(self, rows=None):
+        'Update cell index for *rows* after they were moved or changed; reindex everything if *rows* is None.'
+        if isinstance(self.source, DrawingSheet):  # rows are nested within a group on the source
+            return self.source.reindex()
+
+        if rows is None or any(r.type == 'group' for r in rows):
+            self._cellIndex.invalidate()
+        elif not self._cellIndex.stale:
+            for r in rows:
+                self._cellIndex.update(r)
+
     def iterdeep(self, rows, x=0, y=0, parents=None):
         for r in rows:
             try:
@@ -113,33 +396,55 @@ class DrawingSheet(JsonSheet):
                 if r.type == 'frame': continue
                 if r.ref:
                     assert r.type == 'ref'
-                    g = self.groups[r.ref]
-                    yield from self.iterdeep(g.rows, x+r.x, y+r.y, newparents)
+                    for subr, dx, dy, subparents in self.flatgroup(r.ref):
+                        yield subr, x+r.x+dx, y+r.y+dy, newparents+subparents
                 else:
                     yield r, x+r.x, y+r.y, newparents
-                    yield from self.iterdeep(r.rows or [], x+r.x, x+r.y, newparents)
+                    yield from self.iterdeep(r.rows or [], x+r.x, y+r.y, newparents)
             except Exception as e:
                 vd.exceptionCaught(e)
 
+    def flatgroup(self, gid):
+        'Return list of (row, dx, dy, parents) for all elements within group *gid*, relative to the group.  Cached until the group changes.'
+        g = self.groups[gid]
+        flats = self._cellIndex.flats
+        cached = flats.get(gid)
+        if cached and cached[0] is g and cached[1] is g.rows and cached[2] == len(g.rows or []):
+            return cached[3]
+
+        ret = list(self.iterdeep(g.rows or []))
+        flats[gid] = (g, g.rows, len(g.rows or []), ret)
+        return ret
+
+    def transaction(self):
+        'Return Transaction to change attributes of elements in the current frame of the drawing.'
+        return Transaction(self, self.drawing.currentFrame.id)
+
     def untag_rows(self, rows, s):
-        col = self.column('tags')
-        for row in Progress(rows):
-            v = col.getValue(row)
-            assert isinstance(v, (list, tuple)), type(r).__name__
-            v = [x for x in v if x != s]
-            col.setValue(row, v)
+        with self.transaction() as tx:
+            for row in Progress(rows):
+                v = row.tags or []
+                assert isinstance(v, (list, tuple)), type(row).__name__
+                if s in v:
+                    tx.set(row, 'tags', [x for x in v if x != s])
 
     def tag_rows(self, rows, tagstr):
         tags = tagstr.split()
-        for r in rows:
-            if not r.tags: r.tags = []
-            for tag in tags:
-                if tag not in r.tags:
-                    r.tags.append(tag)
+        with self.transaction() as tx:
+            for r in rows:
+                v = r.tags or []
+                newtags = [tag for tag in tags if tag not in v]
+                if newtags:
+                    tx.set(r, 'tags', list(v) + newtags)
 
     @property
     def groups(self):
-        return {r.id:r for r in self.rows if r.type == 'group'}
+        idx = self._cellIndex
+        if idx.stale:
+            return {r.id:r for r in self.rows if r.type == 'group'}
+        if idx.groupmap is None:
+            idx.groupmap = {r.id:r for r in self.rows if r.type == 'group'}
+        return idx.groupmap
 
     def create_group(self, gname):
         nr = self.newRow()
@@ -184,11 +489,10 @@ class DrawingSheet(JsonSheet):
                     self.addRow(newf, index=i+1)
                     break
 
-            # copy all rows on frame1
-            thisframerows = list(copy(r) for r in self.rows if f1.id in r.frame.split())
-            for r in thisframerows:
-                r.frame = newf.id
-                self.addRow(r)
+            # share all rows on frame1 with the new frame; they are copied when edited in either (see Transaction.own)
+            with Transaction(self) as tx:
+                for r in self.cellIndex.inframes([f1.id], base=False):
+                    tx.set(r, 'frame', r.frame + ' ' + newf.id)
             return newf
         else:
             vd.clearCaches()
@@ -204,9 +508,11 @@ class DrawingSheet(JsonSheet):
         for r in nr.rows:
             r.x = (r.x or 0) - x1
             r.y = (r.y or 0) - y1
+        self.reindex([nr])
 
         def _undoGroupSelected(sheet, group):
             sheet.rows.pop(sheet.rows.index(group))
+            sheet.reindex()
 
         self.deleteSelected()
         self.select([nr])
@@ -215,17 +521,16 @@ class DrawingSheet(JsonSheet):
         vd.status('group "%s" (%d objects)' % (gname, self.nSelectedRows))
 
     def regroup(self, rows):
-        regrouped = []
+        regrouped = []  # original rows that were moved into groups
         groups = set()  # that items were grouped into
         new_rows = deepcopy(rows)
-        for r in new_rows:
+        for oldr, r in zip(rows, new_rows):
             if r.group:
-                regrouped.append(r)
+                regrouped.append(oldr)
                 if r.group not in self.groups:
                     g = self.create_group(r.group)
                     g.x = r.x
                     g.y = r.y
-                    self.addRow(g)
                 else:
                     g = self.groups[r.group]
 
@@ -235,7 +540,8 @@ class DrawingSheet(JsonSheet):
                 vd.addUndo(g.rows.pop, g.rows.index(r))
                 groups.add(r.group)
 
-        self.deleteBy(lambda r,rows=regrouped: r in rows)
+        self.deleteRows(regrouped)
+        self.reindex()
 
         self.select(list(g for name, g in self.groups.items() if name in groups))
 
@@ -257,13 +563,14 @@ class DrawingSheet(JsonSheet):
                 groups.add(r.id)
 
             if r is not parents[0]:
-                self.addRow(r)
                 degrouped.append(r)
 
+        self.addRows(degrouped)
         for g in groups:
             oldrows = copy(self.groups[g].rows)
             self.groups[g].rows.clear()
             vd.addUndo(self.regroup, oldrows)
+        self.reindex()
 
         vd.status('ungrouped %d %s' % (len(degrouped), self.rowtype))
         return degrouped
@@ -276,48 +583,72 @@ class DrawingSheet(JsonSheet):
         for r in rows:
             self.rows.pop(self.rows.index(r))
             self.rows.insert(index, r)
+        self.reindex()
 
     def sort(self):
         vd.fail('sort disabled on drawing sheet')
 
     def save_txt(self, p, *sheets):
-        dwg = self.drawing
-        dwg.draw(None)
+        how = self.options.darkdraw_txt_frames
+        grids = []  # [FrameBuffer of each frame to save] for each sheet
+        for vs in sheets:
+            dwg = vs.drawing
+            frames = vs.frames if how in ('all', 'files') and vs.frames else [dwg.currentFrame]
+            grids.append([dwg.render_grid(f) for f in frames])
+
+        if how == 'files':
+            grids = list(itertools.chain(*grids))
+            for i, grid in enumerate(grids):
+                framep = p.with_name(f'{p.base_stem}-{i+1:0{len(str(len(grids)))}d}' + (f'.{p.ext}' if p.ext else ''))
+                with framep.open_text(mode='w') as fp:
+                    write_txt(fp, grid)
+            vd.status(f'Saved {len(grids)} frames to {p.base_stem}-*')
+            return
+
         with p.open_text(mode='w') as fp:
-            for vs in sheets:
-                line = ''
-                maxX, maxY = dwg.maxXY
-                for y in range(maxY+1):
-                    for x in range(maxX+1):
-                        r = dwg._displayedRows.get((x,y), None)
-                        if r: line += r[-1].text[x-r[-1].x]
-                        else: line += ' '
-                    line = line.rstrip(' ') + '\n'
-
-                    if line.strip():
-                        fp.write(line)
-                        line = ''
-                    # if only newlines, let it ride
+            for sheetgrids in grids:
+                nlines = max(g.y1+g.h for g in sheetgrids) if how == 'all' else 0
+                for grid in sheetgrids:
+                    write_txt(fp, grid, nlines)
+
+
+@DrawingSheet.lazy_property
+def _cellIndex(sheet):
+    return CellIndex(sheet)
+
+
+DrawingSheet.init('_rowids', lambda: (None, set()))  # (rows, set of id(row) for rows in that list)
 
 
 class Drawing(TextCanvas):
     rowtype = 'elements'  # rowdef: AttrDict (same as DrawingSheet)
     def iterbox(self, box, n=None, frames=None):
-        'If *frames* is None, return top *n* elements from each cell within the given box (current frame falling back to base frame).  Otherwise return all elements from each cell within the given box (so base frame + current frame).  Otherwise return all elements that would be displayed in displayed in either If frames is None, uses actually displayed elements; otherwise, '
-        ret = list()
+        'Return toprows of elements covering any cell within *box*, each once.  If *frames* is None, only those displayed (current frame falling back to base frame), in drawing order; if *n* given, only the top *n* in each cell, in cell order.  Otherwise, all elements in the base frame or any of *frames*, in drawing order.'
+        idx = self.source.cellIndex
+        x1, y1, x2, y2 = box.x1, box.y1, box.x1+box.w, box.y1+box.h
+        ret = {}  # id(row) -> row
         if frames is None:
-            for ny in range(box.y1, box.y2-1):
-                for nx in range(box.x1, box.x2-1):
-                    for r in self._displayedRows[(nx,ny)][-(n or 0):]:
-                        if r not in ret:
-                            ret.append(r)
+            view = self._displayedRows
+            if not isinstance(view, CellView):  # not drawn yet
+                view = CellView(self.source, self.currentFrame, self.disabled_tags)
+            if n:
+                for ny in range(y1, y2):
+                    for nx in range(x1, x2):
+                        for r in view[(nx,ny)][-n:]:
+                            ret.setdefault(id(r), r)
+            else:
+                for p in idx.inbox(x1, y1, x2, y2, [view.frame.id] if view.frame.id else [], view.visible):
+                    ret.setdefault(id(p.toprow), p.toprow)
         else:
-            for r in self.rows:
-                if self.inFrame(r, frames):
-                    if box.contains(CharBox(None, r.x, r.y, r.w or dispwidth(r.text or ''), r.h or 1)):
-                        ret.append(r)
+            for p in idx.inbox(x1, y1, x2, y2, [f.id for f in frames]):
+                r = p.toprow
+                if r.type:
+                    continue
+                if (r.w or r.h) and not box.contains(CharBox(None, r.x, r.y, r.w or dispwidth(r.text or ''), r.h or 1)):
+                    continue  # inbox() only checked the cells of its text
+                ret.setdefault(id(r), r)
 
-        return ret
+        return list(ret.values())
 
     def __getattr__(self, k):
         if k == 'source' or self.source is self:
@@ -337,14 +668,15 @@ class Drawing(TextCanvas):
 
     def elements(self, frames=None):
         'Return elements in *frames*.  If *frames* is None, then base image only.  Otherwise, *frames* must be a list of frame rows (like from .currentFrame or .frames).'
-        return [r for r in self.rows if self.inFrame(r, frames)]
+        return [r for r in self.source.cellIndex.inframes([f.id for f in frames or []]) if not r.type]
 
     def inFrame(self, r, frames):
         'Return True if *r* is an element that would be displayed (even if hidden or buried) in the given set of *frames*.'
         if r.type: return False  # frame or other non-element type
         if not r.frame: return True
         if not frames: return False
-        return any(f.id in r.frame.split() for f in frames)
+        fids = frameset(r.frame)
+        return any(f.id in fids for f in frames)
 
     def moveToRow(self, rowstr):
         a, b = map(int, rowstr.split())
@@ -380,27 +712,9 @@ class Drawing(TextCanvas):
         thisframe = self.currentFrame
         if self.autoplay_frames:
             vd.timeouts_before_idle = -1
-            ft, f = self.autoplay_frames[0]
-            thisframe = f
-            if not ft:
-                self.autoplay_frames[0][0] = now
-            elif now-ft > f.duration_ms/1000:
-                self.autoplay_frames.pop(0)
-                if self.autoplay_frames:
-                    self.autoplay_frames[0][0] = now
-                    thisframe = self.autoplay_frames[0][1]
-                    vd.curses_timeout = thisframe.duration_ms
-                else:
-                    # Reset to frame 0 by repopulating autoplay_frames
-                    self.autoplay_frames = [[0, f] for f in self.frames]
-                    self.cursorFrameIndex = 0
-                    self.autoplay_frames[0][0] = now
-                    thisframe = self.autoplay_frames[0][1]
-                    vd.curses_timeout = thisframe.duration_ms
-                    #vd.status('looped back to frame 0')
+            thisframe = self.autoplay_frame(now)
 
-        self._displayedRows = defaultdict(list)  # (x, y) -> list of rows; actual screen layout (topmost last in list)
-        self._tags = defaultdict(list)  # "tag" -> list of rows with that tag
+        self._displayedRows = CellView(self.source, thisframe, self.disabled_tags)  # (x, y) -> list of rows; actual screen layout (topmost last in list)
 
         selectedGroups = set()  # any group with a selected element
 
@@ -415,54 +729,87 @@ class Drawing(TextCanvas):
                     if y < self.windowHeight-1:
                         scr.addstr(y, xmax, '|')
 
-        #draw_guides(self.maxX+1, self.maxY+1)
-        guidexy = self.options.disp_guide_xy
-        if guidexy:
-            try:
-                guidex,guidey = map(int, guidexy.split())
-                draw_guides(guidex, guidey)
-            except Exception as e:
-                vd.exceptionCaught(e)
-
-        # draw blank cursor as backdrop but on top of guides
-        for i in range(self.cursorBox.h):
-            for j in range(self.cursorBox.w):
-                y = self.cursorBox.y1+i-self.yoffset
-                x = self.cursorBox.x1+j-self.xoffset
-                clipdraw(scr, y, x, ' ', colors.color_current_row)
-
-        for r, x, y, parents in self.iterdeep(self.source.rows):
-            sy = y - self.yoffset
-            sx = x - self.xoffset
-            toprow = parents[0]
-            for g in (r.tags or []):
-                self._tags[g].append(r)
+        dirty = self.dirty_cells(scr, thisframe)
+        if self.autoplay_frames:
+            # blit pre-composited frame, or only the cells that differ from the one on screen; no cursor or selection during playback
+            buf = self.render_grid(thisframe)
+            if dirty is None or self._played is None:
+                scr.erase()
+                scr.bkgd(' ', colors.color_default.attr)
+                self.blit(scr, buf)
+            elif buf is not self._played:
+                self.blit(scr, buf, buf.delta(self._played))
+            self._played = buf
+            placements = []
+        elif dirty is None:
+            scr.erase()
+            scr.bkgd(' ', colors.color_default.attr)
+
+            #draw_guides(self.maxX+1, self.maxY+1)
+            guidexy = self.options.disp_guide_xy
+            if guidexy:
+                try:
+                    guidex,guidey = map(int, guidexy.split())
+                    draw_guides(guidex, guidey)
+                except Exception as e:
+                    vd.exceptionCaught(e)
+
+            # draw blank cursor as backdrop but on top of guides
+            for i in range(self.cursorBox.h):
+                for j in range(self.cursorBox.w):
+                    y = self.cursorBox.y1+i-self.yoffset
+                    x = self.cursorBox.x1+j-self.xoffset
+                    self.clipdraw(scr, y, x, ' ', colors.color_current_row)
+
+            # only visit elements in tiles touching the window
+            placements = self.source.cellIndex.iterwindow(self.xoffset, self.yoffset, self.windowWidth, self.windowHeight-2, thisframe)
+        else:
+            # only repaint elements over cells that changed since the last draw
+            placements = self.source.cellIndex.dirty(dirty, self._displayedRows.visible)
+            self.draw_backdrop(scr, dirty)
+            for y in range(self.windowHeight-2, self.windowHeight):
+                try:
+                    scr.move(y, 0)
+                    scr.clrtoeol()
+                except curses.error:
+                    pass
+
+        stats = self.drawstats
+        attrs = colorattrs.refresh(self.options)
+        box, isSelected, disabled_tags = self.cursorBox, self.source.isSelected, self.disabled_tags
+        xoffset, yoffset, h, w = self.xoffset, self.yoffset, self.windowHeight-2, self.windowWidth
+        nvisited = ndrawn = ncells = 0
+        for p in placements:
+            nvisited += 1
+            r, x, y, toprow = p.row, p.x, p.y, p.toprow
+            sy = y - yoffset
+            sx = x - xoffset
 
             if not r.text: continue
-            if any_match(r.tags, self.disabled_tags): continue
-            if toprow.frame or r.frame:
-                if not self.inFrame(r, [thisframe]): continue
-
-            c = r.color or ''
-            if self.cursorBox.contains(CharBox(scr, x, y, r.w or dispwidth(r.text), r.h or 1)):
-                c = self.options.color_current_row + ' ' + str(c)
-            if self.source.isSelected(toprow):
-                c = self.options.color_selected_row + ' ' + str(c)
-                if r.tags: selectedGroups |= set(r.tags)
-            a = colors[c]
-
-            if (0 <= sy < self.windowHeight-2 and 0 <= sx < self.windowWidth):  # inside screen
-                w = clipdraw(scr, sy, sx, r.text, a)
-
-            for i in range(0, dispwidth(r.text)):
-                cellrows = self._displayedRows[(x+i, y)]
-                if toprow not in cellrows:
-                    cellrows.append(toprow)
+            if any_match(r.tags, disabled_tags): continue
+
+            if (0 <= sy < h and 0 <= sx < w):  # inside screen
+                rw = r.w or dispwidth(r.text)
+                a = attrs.get(r.color or '',
+                              box.contains(CharBox(scr, x, y, rw, r.h or 1)),
+                              isSelected(toprow))
+                clipdraw(scr, sy, sx, r.text, a)
+                ndrawn += 1
+                ncells += rw
+
+        if stats:
+            stats.lap('composite')
+            # culled: elements in this frame never visited, because their tile was outside the window or their cells had not changed
+            nculled = 0 if self.autoplay_frames else self.source.cellIndex.nframe(thisframe)-nvisited
+            stats.count(visited=nvisited, culled=nculled, drawn=ndrawn, cells=ncells, clipdraw=ndrawn)
 
         defcolor = self.options.color_default
         defattr = colors[defcolor]
         if self.options.visibility == 1: # draw tags
-            clipdraw(scr, 0, self.windowWidth-20, '  00: (reset)  ', defattr)
+            for r, x, y, parents in self.iterdeep(self.source.selectedRows):
+                if r.tags: selectedGroups |= set(r.tags)
+
+            self.clipdraw(scr, 0, self.windowWidth-20, '  00: (reset)  ', defattr)
             for i, tag in enumerate(self._tags.keys()):
                 c = defcolor
                 if tag in self.disabled_tags:
@@ -471,47 +818,182 @@ class Drawing(TextCanvas):
                     c = self.options.color_current_row + ' ' + c
                 if tag in selectedGroups:
                     c = self.options.color_selected_row + ' ' + c
-                clipdraw(scr, i+1, self.windowWidth-20, '  %02d: %7s  ' % (i+1, tag), colors[c])
+                self.clipdraw(scr, i+1, self.windowWidth-20, '  %02d: %7s  ' % (i+1, tag), colors[c])
 
         elif self.options.visibility == 2: # draw clipboard item shortcuts
-            x += clipdraw(scr, 0, self.windowWidth-20, 'clipboard %d' % vd.clipboard_index, colors['underline'])
+            x += self.clipdraw(scr, 0, self.windowWidth-20, 'clipboard %d' % vd.clipboard_index, colors['underline'])
             for i, r in enumerate(vd.current_charset[:10]):
                 x = self.windowWidth-20
-                x += clipdraw(scr, i+1, x, '  %d: ' % (i+1), defattr)
-                x += clipdraw(scr, i+1, x, r.text + '  ', colors[r.color])
+                x += self.clipdraw(scr, i+1, x, '  %d: ' % (i+1), defattr)
+                x += self.clipdraw(scr, i+1, x, r.text + '  ', colors[r.color])
 
+        if stats:
+            stats.lap('overlay')
 
         # draw lstatus2 (paste status with default color)
         y = self.windowHeight-2
         x = 3
-        x += clipdraw(scr, y, x, f'paste {self.paste_mode} {"base" if self.options.ddw_add_baseframe else ""} ', defattr)
+        x += self.clipdraw(scr, y, x, f'paste {self.paste_mode} {"base" if self.options.ddw_add_baseframe else ""} ', defattr)
 
-        x += clipdraw(scr, y, x, ' %s %s ' % (len(vd.getClipboardRows() or []), self.rowtype), defattr)
+        x += self.clipdraw(scr, y, x, ' %s %s ' % (len(vd.getClipboardRows() or []), self.rowtype), defattr)
 
-        x += clipdraw(scr, y, x, '  default color: ', defattr)
-        x += clipdraw(scr, y, x, '##', colors[vd.default_color])
-        x += clipdraw(scr, y, x, ' %s' % vd.default_color, defattr)
+        x += self.clipdraw(scr, y, x, '  default color: ', defattr)
+        x += self.clipdraw(scr, y, x, '##', colors[vd.default_color])
+        x += self.clipdraw(scr, y, x, ' %s' % vd.default_color, defattr)
 
         x += 3
-        x += clipdraw(scr, y, x, ' %s: ' % vd.clipboard_index, defattr)
+        x += self.clipdraw(scr, y, x, ' %s: ' % vd.clipboard_index, defattr)
 
         for i, r in enumerate(vd.current_charset[:10]):
-            x += clipdraw(scr, y, x, str(i+1)[-1], defattr)
-            x += clipdraw(scr, y, x, r.text, colors[vd.default_color])
+            x += self.clipdraw(scr, y, x, str(i+1)[-1], defattr)
+            x += self.clipdraw(scr, y, x, r.text, colors[vd.default_color])
             x += 1
 
         # draw rstatus2 (cursor status)
         if hasattr(self, 'cursorRows') and self.cursorRows:
             c = self.cursorRows[0].color
             x = self.windowWidth-30-len(c)
-            x += clipdraw(scr, y, x, '%s  ' % c, defattr)
-            x += clipdraw(scr, y, x, '##', colors[c])
+            x += self.clipdraw(scr, y, x, '%s  ' % c, defattr)
+            x += self.clipdraw(scr, y, x, '##', colors[c])
             if self.cursorChar:
-                x += clipdraw(scr, y, x, ' '+self.cursorChar[0], colors[c], w=3)
-                x += clipdraw(scr, y, x, ' U+%04X' % ord(self.cursorChar[0]), defattr)
+                x += self.clipdraw(scr, y, x, ' '+self.cursorChar[0], colors[c], w=3)
+                x += self.clipdraw(scr, y, x, ' U+%04X' % ord(self.cursorChar[0]), defattr)
 
         x = self.windowWidth-16
-        x += clipdraw(scr, y, x, '  %s' % self.cursorBox, defattr)
+        x += self.clipdraw(scr, y, x, '  %s' % self.cursorBox, defattr)
+
+        if stats:
+            stats.lap('status')
+
+    def autoplay_frame(self, now):
+        'Return the frame in autoplay_frames due at time *now*, skipping any whose time has already passed, and set the timeout to wake up for the next one.'
+        if not self.autoplay_frames[0][0]:
+            self.autoplay_frames[0][0] = now
+        durations = [(f.duration_ms or 100) for ft, f in self.autoplay_frames]
+        t = (now - self.autoplay_frames[0][0])*1000 % sum(durations)
+        for (ft, f), ms in zip(self.autoplay_frames, durations):
+            if t < ms:
+                vd.curses_timeout = max(1, int(ms - t))
+                return f
+            t -= ms
+        return self.autoplay_frames[-1][1]
+
+    def render_grid(self, frame=None):
+        'Return FrameBuffer with the final glyph and color of each visible cell in *frame* (base only if None), without cursor, selection, or screen.  Composited once and cached until an element in that frame changes.'
+        frame = frame or AttrDict()
+        idx = self.source.cellIndex
+        key = (idx.generation(frame), tuple(sorted(self.disabled_tags)))
+        bufs = self._framebufs
+        buf = bufs.pop(frame.id, None)
+        if buf is None or buf.key != key:
+            buf = composite(idx.iterframe(frame), CellView(self.source, frame, self.disabled_tags).visible)
+            buf.key = key
+        bufs[frame.id] = buf  # most recently used last
+        limit = self.options.ddw_frame_cache_size or self.nFrames+1  # and the base frame
+        maxbytes = self.options.ddw_frame_cache_mb*2**20
+        while len(bufs) > 1 and (len(bufs) > limit or sum(b.nbytes for b in bufs.values()) > maxbytes):
+            # evict the most recently used before this one: playback cycles through the frames in order, so evicting the least recently used would miss on every frame once they don't all fit
+            it = reversed(bufs)
+            next(it)
+            del bufs[next(it)]
+        return buf
+
+    def blit(self, scr, buf, delta=None):
+        'Draw the part of FrameBuffer *buf* that is inside the window; if *delta* given, only those runs of it.'
+        x1, x2 = self.xoffset, self.xoffset+self.windowWidth
+        attrs = colorattrs.refresh(self.options)
+        n = 0
+        if delta is None:
+            for sy in range(self.windowHeight-2):
+                for x, text, color in buf.iterruns(sy+self.yoffset, x1, x2):
+                    clipdraw(scr, sy, x-x1, text, attrs.get(color), literal=True)
+                    n += 1
+        else:
+            for y, x, glyphs, color in delta:
+                sy = y-self.yoffset
+                clipped = clip(x, glyphs, x1, x2)
+                if clipped and 0 <= sy < self.windowHeight-2:
+                    x, text = clipped
+                    clipdraw(scr, sy, x-x1, text, attrs.get(color), literal=True)
+                    n += 1
+
+        if self.drawstats:
+            self.drawstats.clipdraw += n
+
+    def clipdraw(self, scr, y, x, s, attr, **kwargs):
+        'clipdraw() onto *scr*, counted in the stats of the current draw if any.'
+        if self.drawstats:
+            self.drawstats.clipdraw += 1
+        return clipdraw(scr, y, x, s, attr, **kwargs)
+
+    def redraw_all(self):
+        'Repaint everything on the next draw, instead of only the cells that changed.'
+        self._lastdraw = None
+
+    def dirty_cells(self, scr, frame):
+        'Return set of (x,y) cells to repaint since the last draw on *scr*, or None if everything must be repainted.'
+        idx = self.source.cellIndex
+        changed, idx.changed = idx.changed, set()
+
+        box = self.cursorBox
+        cursor = (box.x1, box.y1, box.w, box.h)
+        selected = set(self.source._selectedRows.keys())
+        playing = bool(self.autoplay_frames)  # frame changes are deltas during autoplay
+        sig = (id(scr), scr.getmaxyx(), self.xoffset, self.yoffset, playing, None if playing else frame.id,
+               tuple(sorted(self.disabled_tags)), self.options.disp_guide_xy, self.options.visibility,
+               self.options.color_current_row, self.options.color_selected_row,
+               vd.menuRunning, len(self._tags) if self.options.visibility == 1 else 0, self.options.ddw_drawstats)
+
+        last, self._lastdraw = self._lastdraw, AttrDict(sig=sig, cursor=cursor, selected=selected)
+        if changed is None or not last or last.sig != sig:
+            return None
+        if getattr(self, 'current_sidebar', None):  # sidebar was drawn over the canvas
+            return None
+
+        dirty = changed
+        if cursor != last.cursor:
+            for x1, y1, w, h in (cursor, last.cursor):
+                dirty.update((x1+j, y1+i) for i in range(h) for j in range(w))
+
+        for rowid in selected ^ last.selected:
+            for p, xys in idx.placed.get(rowid, (None, (), []))[2]:
+                dirty.update(xys)
+
+        return dirty
+
+    def draw_backdrop(self, scr, xys):
+        'Clear cells *xys* to guides and blank cursor, as when drawing from scratch.'
+        guidex = guidey = None
+        if self.options.disp_guide_xy:
+            try:
+                guidex, guidey = map(int, self.options.disp_guide_xy.split())
+            except Exception:
+                pass
+
+        for x, y in xys:
+            sx, sy = x-self.xoffset, y-self.yoffset
+            if not (0 <= sy < self.windowHeight-2 and 0 <= sx < self.windowWidth):
+                continue
+
+            ch = ' '
+            if guidey is not None:
+                if sy == guidey and sx < guidex and sx < self.windowWidth-1:
+                    ch = '-'
+                elif sx == guidex and sy < guidey and guidex < self.windowWidth-1:
+                    ch = '|'
+
+            if self.cursorBox.contains(CharBox(None, x, y, 1, 1)):
+                self.clipdraw(scr, sy, sx, ' ', colors.color_current_row)
+            else:
+                try:
+                    scr.addstr(sy, sx, ch)
+                except curses.error:
+                    pass
+
+    @property
+    def _tags(self):
+        'tag -> list of elements with that tag, in drawing order.'
+        return {tag: list(rows.values()) for tag, rows in self.source.cellIndex.tags.items() if rows}
 
     def stop_animation(self):
         self.autoplay_frames = []
@@ -526,12 +1008,16 @@ class Drawing(TextCanvas):
         if self._scr:
             self.draw(self._scr)
 
-    def add_text(self, text, x, y, color=''):
+    def text_row(self, text, x, y, color=''):
+        'Return new element for *text* at (x,y) in the current frame, without adding it.'
         r = self.newRow()
         r.x, r.y, r.text, r.color = x, y, text, color
         if not self.options.ddw_add_baseframe:
             r.frame = self.currentFrame.id
+        return r
 
+    def add_text(self, text, x, y, color=''):
+        r = self.text_row(text, x, y, color)
         self.source.addRow(r)
         return r
 
@@ -562,13 +1048,34 @@ class Drawing(TextCanvas):
 
         self.place_text(vd.current_charset[n].text, box, color=color)
 
+    def transaction(self):
+        'Return Transaction to change attributes of elements in the current frame, with one undo and one reindex for all of them.'
+        return Transaction(self.source, self.currentFrame.id)
+
+    def slide(self, rows, dx, dy):
+        'Move *rows* by (*dx*,*dy*), not beyond the top-left, in the current frame only.'
+        x1, y1, x2, y2 = boundingBox(rows)
+        if x1+dx < 0: dx = -x1
+        if y1+dy < 0: dy = -y1
+        with self.transaction() as tx:
+            for r in rows:
+                if r.x is not None:
+                    tx.set(r, 'x', r.x+dx)
+                if r.y is not None:
+                    tx.set(r, 'y', r.y+dy)
+
+    def delete_rows(self, rows):
+        'Remove *rows* from the current frame: elements shared with other frames stay in those, the rest are deleted.'
+        with self.transaction() as tx:
+            rows = [r for r in rows if not tx.drop(r)]
+        self.source.deleteRows(rows)
+
     def edit_text(self, text, row):
         if row is None:
             self.place_text(text, self.cursorBox, dx=1)
             return
-        oldtext = row.text
-        row.text = text
-        vd.addUndo(setattr, row, 'text', oldtext)
+        with self.transaction() as tx:
+            tx.set(row, 'text', text)
 
 
     def get_text(self, x=None, y=None):
@@ -581,7 +1088,7 @@ class Drawing(TextCanvas):
 
     def remove_at(self, box):
         rows = list(self.iterbox(box))
-        self.source.deleteBy(lambda r,rows=rows: r in rows)
+        self.delete_rows(rows)
         return rows
 
     @property
@@ -684,10 +1191,12 @@ class Drawing(TextCanvas):
         x=self.cursorBox.x1
         y=self.cursorBox.y1
         currows = self._displayedRows.get((x, y), [])
-        xmin = min(x for x, y in self._displayedRows.keys())
-        ymin = min(y for x, y in self._displayedRows.keys())
-        xmax = max(x for x, y in self._displayedRows.keys())
-        ymax = max(y for x, y in self._displayedRows.keys())
+        xys = self._displayedRows.keys()
+        if not xys: return
+        xmin = min(x for x, y in xys)
+        ymin = min(y for x, y in xys)
+        xmax = max(x for x, y in xys)
+        ymax = max(y for x, y in xys)
 
         while xmin <= x <= xmax and ymin <= y <= ymax:
             for r in self._displayedRows.get((x, y), [])[::-1]:
@@ -720,9 +1229,9 @@ class Drawing(TextCanvas):
             self.xoffset = self.cursorBox.x1 - self.windowWidth+2
 
     def join_rows(dwg, rows):
-        vd.addUndo(setattr, rows[0], 'text', rows[0].text)
-        rows[0].text = ''.join(r.text for r in rows)
-        dwg.source.deleteBy(lambda r,rows=rows[1:]: r in rows)
+        with dwg.transaction() as tx:
+            tx.set(rows[0], 'text', ''.join(r.text for r in rows))
+        dwg.delete_rows(rows[1:])
 
     def cycle_paste_mode(self):
         modes = ['all', 'char', 'color']
@@ -748,25 +1257,30 @@ class Drawing(TextCanvas):
                         r.color = vd.default_color
                     newrows.append(r)
                     nfilled += 1
-                    self.source.addRow(r)
                 elif self.paste_mode == 'color':
                     if oldr.color and newx < box.x2 and newy < box.y2-1:
-                        for existing in self._displayedRows[(newx, newy)][-(n or 0):]:
-                            nfilled += 1
-                            existing.color = oldr.color
+                        with self.transaction() as tx:
+                            for existing in self._displayedRows[(newx, newy)][-(n or 0):]:
+                                nfilled += 1
+                                tx.set(existing, 'color', oldr.color)
                 newx += dispwidth(oldr.text)
 
+        self.source.addRows(newrows)
         vd.status(f'filled {nfilled} cells')
         if nfilled == 0:
             vd.warning(f'paste mode {self.paste_mode} had nothing to fill')
 
-    def paste_chars(self, srcrows, box, n=None):
+    def paste_chars(self, srcrows, box, n=None, newrows=None):
         # n is number of rows deep to change color
+        # if newrows is given, append new elements to it for the caller to add, instead of adding them
         srcrows or vd.fail('no rows to paste')
 
-        newrows = []
+        batch = newrows is not None
+        if not batch:
+            newrows = []
         npasted = 0
-        frameset = set(r.frame for r in srcrows)
+        srcframes = set(r.frame for r in srcrows)
+        fids = set(f.id for f in self.frames)
         x1, y1, x2, y2 = boundingBox(srcrows)
         for oldr in srcrows:
             if oldr.x is None:
@@ -783,9 +1297,9 @@ class Drawing(TextCanvas):
                 r.update(deepcopy(oldr))
                 if self.options.ddw_add_baseframe:
                     r.frame = None
-                elif oldr.frame not in [f.id for f in self.frames]:
+                elif not oldr.frame or not (frameset(oldr.frame) & fids):
                     r.frame = None
-                elif len(frameset) == 1:  # if all characters are only in a single frame, add to current frame instead
+                elif len(srcframes) == 1:  # if all characters are only in a single frame, add to current frame instead
                     r.frame = self.currentFrame.id
                 # else use paste to their existing frame
 
@@ -794,14 +1308,16 @@ class Drawing(TextCanvas):
                 if self.paste_mode == 'char':
                     r.color = vd.default_color
                 newrows.append(r)
-                self.source.addRow(r)
                 npasted += 1
             elif self.paste_mode == 'color':
                 if oldr.color and newx < box.x2 and newy < box.y2-1:
-                    for existing in self._displayedRows[(newx, newy)][-(n or 0):]:
-                        npasted += 1
-                        existing.color = oldr.color
+                    with self.transaction() as tx:
+                        for existing in self._displayedRows[(newx, newy)][-(n or 0):]:
+                            npasted += 1
+                            tx.set(existing, 'color', oldr.color)
 
+        if not batch:
+            self.source.addRows(newrows)
         if npasted == 0:
             vd.warning(f'paste mode {self.paste_mode} had nothing to paste')
 
@@ -827,8 +1343,50 @@ class Drawing(TextCanvas):
 
     def align_selected(self, attrname):
         rows = self.someSelectedRows
-        for r in rows:
-            r.x = rows[0].x
+        with self.transaction() as tx:
+            for r in rows:
+                tx.set(r, 'x', rows[0].x)
+
+
+def _reindex_undone(vd, sheet):
+    if isinstance(sheet, Drawing):
+        sheet = sheet.source
+    if isinstance(sheet, DrawingSheet):
+        sheet.reindex()  # undo funcs may have changed anything
+
+@VisiData.after
+def undo(vd, sheet):
+    _reindex_undone(vd, sheet)
+
+@VisiData.after
+def redo(vd, sheet):
+    _reindex_undone(vd, sheet)
+
+
+_lastDrawn = {}  # id(scr) -> sheet last drawn on that window
+
+@VisiData.around
+def drawSheet(vd, drawSheet, scr, sheet):
+    'Let Drawings repaint only what changed, instead of erasing the window first.'
+    prev = _lastDrawn.get(id(scr))
+    _lastDrawn[id(scr)] = sheet
+    if not scr or not isinstance(sheet, Drawing):
+        return drawSheet(vd, scr, sheet)
+
+    if prev is not sheet:
+        sheet.redraw_all()
+
+    sheet.ensureLoaded()
+    sheet._scr = scr
+    vd.callNoExceptions(sheet.draw, scr)  # erases scr if needed
+    vd.callNoExceptions(vd.drawLeftStatus, scr, sheet)
+    vd.callNoExceptions(vd.drawRightStatus, scr, sheet)
+
+
+@Drawing.after
+def execCommand2(sheet, cmd, vdglobals=None):
+    if cmd.longname == 'redraw' or 'input' in cmd.execstr:  # prompts are drawn over the canvas
+        sheet.redraw_all()
 
 
 @VisiData.api
@@ -855,23 +1413,23 @@ def input_canvas(sheet, box, row=None):
 
 @Drawing.api
 def cycle_color(sheet, rows, n=1):
-    for r in rows:
-       clist = []
-       for c in r.color.split():
-           try:
-                c = str((int(c)+n) % 256)
-           except Exception:
-                pass
-           clist.append(c)
-       r.color = ''.join(clist)
+    with sheet.transaction() as tx:
+        for r in rows:
+            clist = []
+            for c in r.color.split():
+                try:
+                    c = str((int(c)+n) % 256)
+                except Exception:
+                    pass
+                clist.append(c)
+            tx.set(r, 'color', ''.join(clist))
 
 
 @Drawing.api
 def set_color(self, color, rows):
-    for r in rows:
-        oldcolor = copy(r.color)
-        r.color = color
-        vd.addUndo(setattr, r, 'color', oldcolor)
+    with self.transaction() as tx:
+        for r in rows:
+            tx.set(r, 'color', color)
 
 @Drawing.api
 def select_top(sheet, box):
@@ -919,8 +1477,10 @@ def next_point(sheet, x2, y2):
             # reverse engineered bezier equation to draw with a point *on* the curve
             ctrlX = 2 * x2 - 0.5 * (xy1[0] + xy3[0])
             ctrlY = 2 * y2 - 0.5 * (xy1[1] + xy3[1])
+            newrows = []
             for x, y in bezier(*xy1, ctrlX, ctrlY, *xy3):
-                sheet.paste_chars([next(objit)], CharBox(None, int(x), int(y), 1, 1))
+                sheet.paste_chars([next(objit)], CharBox(None, int(x), int(y), 1, 1), newrows=newrows)
+            sheet.source.addRows(newrows)
 
         sheet.linepoints = [sheet.linepoints[-1]]
 
@@ -951,10 +1511,11 @@ def draw_line(self, objlist, x0, y0, x1, y1):
     error = dx + dy
 
     objit = itertools.cycle(objlist)
+    newrows = []
 
     while True:
         row = next(objit)
-        self.paste_chars([row], CharBox(None, x0, y0, 1, 1))
+        self.paste_chars([row], CharBox(None, x0, y0, 1, 1), newrows=newrows)
 
         if x0 == x1 and y0 == y1:
             break
@@ -968,24 +1529,29 @@ def draw_line(self, objlist, x0, y0, x1, y1):
             error += dx
             y0 += sy
 
+    self.source.addRows(newrows)
+
 
 @Drawing.api
 def split_rows(sheet, rows):
-    vd.addUndo(setattr, sheet.source, 'rows', copy(sheet.source.rows))
-
-    for row in rows:
-        i = sheet.source.rows.index(row)
-        newrows = []
-        dx = 0
-        for ch in row.text:
-            newr = copy(row)
-            newr.text = ch
-            newr.x += dx
-            dx += dispwidth(ch)
-            newrows.append(newr)
-
-        sheet.source.rows[i:i+1] = newrows
-
+    'Split text of each of *rows* into one element per character; the row keeps the first character, with the rest in new elements just above it.'
+    after = {}  # id(row) -> [new elements for the rest of its text]
+    with sheet.transaction() as tx:
+        for row in {id(r): r for r in rows}.values():
+            if not row.text or len(row.text) < 2:
+                continue
+            row = tx.own(row)
+            newrows = after[id(row)] = []
+            dx = dispwidth(row.text[0])
+            for ch in row.text[1:]:
+                newr = copy(row)
+                newr.text = ch
+                newr.x += dx
+                dx += dispwidth(ch)
+                newrows.append(newr)
+            tx.set(row, 'text', row.text[0])
+
+    sheet.source.addRowsAfter(after)
 
 @Drawing.command('', 'box-cursor', 'draw a box to fill the inner edge of the cursor')
 def box_cursor(sheet):
@@ -1002,8 +1568,11 @@ Drawing.init('disabled_tags', set)  # set of groupnames which should not be draw
 Drawing.init('mark', lambda: (0,0))
 Drawing.init('paste_mode', lambda: 'all')
 Drawing.init('cursorFrameIndex', lambda: 0)
-Drawing.init('autoplay_frames', list)
+Drawing.init('autoplay_frames', list)  # [[starttime, frame], ...] to play in order; starttime of the first is when playback began
+Drawing.init('_framebufs', dict)  # frameid -> FrameBuffer, least recently used first
+Drawing.init('_played', lambda: None)  # FrameBuffer on screen during autoplay
 Drawing.init('last_autosave', int)
+Drawing.init('_lastdraw', lambda: None)  # AttrDict(sig, cursor, selected) as of last draw; None to repaint everything
 
 # (xoffset, yoffset) is absolute coordinate of upper left of viewport (0, 0)
 Drawing.init('yoffset', int)
@@ -1050,11 +1619,11 @@ Drawing.addCommand('d', 'delete-cursor', 'remove_at(cursorBox)', 'delete first i
 Drawing.addCommand('gd', 'delete-selected', 'source.deleteSelected()', 'delete selected rows on source sheet')
 Drawing.addCommand('a', 'add-input', 'place_text(input_canvas(cursorBox, None), cursorBox)', 'place text string at cursor')
 Drawing.addCommand('e', 'edit-text', 'r=cursorRow; edit_text(input_canvas(cursorBox, r), r)')
-Drawing.addCommand('ge', 'edit-selected', 'v=input("text: ", value=get_text())\nfor r in source.selectedRows: r.text=v')
+Drawing.addCommand('ge', 'edit-selected', 'v=input("text: ", value=get_text())\nwith transaction() as tx:\n    for r in source.selectedRows: tx.set(r, "text", v)')
 Drawing.addCommand('y', 'yank-char', 'sheet.copyRows(cursorRows)')
 Drawing.addCommand('gy', 'yank-selected', 'sheet.copyRows(sheet.selectedRows)')
 Drawing.addCommand('x', 'cut-char', 'sheet.copyRows(remove_at(cursorBox))')
-Drawing.addCommand('zx', 'cut-char-top', 'r=list(itercursor())[-1]; sheet.copyRows([r]); source.deleteBy(lambda r,row=r: r is row)')
+Drawing.addCommand('zx', 'cut-char-top', 'r=list(itercursor())[-1]; sheet.copyRows([r]); sheet.delete_rows([r])')
 Drawing.addCommand('p', 'paste-chars', 'sheet.paste_chars(vd.getClipboardRows(), cursorBox)')
 Drawing.addCommand('zp', 'paste-special', 'sheet.paste_special()')
 Drawing.addCommand('f', 'fill-chars', 'sheet.fill_chars(vd.getClipboardRows(), cursorBox)', 'fill cursor with clipboard items')
@@ -1074,8 +1643,8 @@ DrawingSheet.addCommand('gz(', 'degroup-selected-temp', 'degroup = sheet.degroup
 DrawingSheet.addCommand('gz)', 'regroup-selected', 'sheet.regroup(someSelectedRows)')
 
 Drawing.addCommand('zs', 'select-top', 'select_top(cursorBox)')
-Drawing.addCommand('gzs', 'select-all-this-frame', 'sheet.select(list(source.gatherBy(lambda r,f=currentFrame: r.frame == f.id)))')
-Drawing.addCommand('gzu', 'unselect-all-this-frame', 'sheet.unselect(list(source.gatherBy(lambda r,f=currentFrame: r.frame == f.id)))')
+Drawing.addCommand('gzs', 'select-all-this-frame', 'sheet.select(source.cellIndex.inframes([currentFrame.id], base=False))')
+Drawing.addCommand('gzu', 'unselect-all-this-frame', 'sheet.unselect(source.cellIndex.inframes([currentFrame.id], base=False))')
 Drawing.addCommand(',', 'select-equal-char', 'sheet.select(list(source.gatherBy(lambda r,ch=cursorChar: r.text==ch)))')
 Drawing.addCommand('|', 'select-tag', 'sheet.select_tag(input("select tag: ", type="group"))')
 Drawing.addCommand('\\', 'unselect-tag', 'sheet.unselect_tag(input("unselect tag: ", type="group"))')
@@ -1127,8 +1696,8 @@ Drawing.addCommand('zCtrl+Y', 'pyobj-cursor', 'vd.push(PyobjSheet("cursor_top",
 Drawing.addCommand('Ctrl+Y', 'pyobj-cursor', 'vd.push(PyobjSheet("cursor", source=cursorRows))')
 
 Drawing.addCommand('Ctrl+S', 'save-sheet', 'vd.saveSheets(inputPath("save to: ", value=source.getDefaultSaveName()), sheet.source)', 'save current drawing')
-Drawing.addCommand('i', 'insert-row', 'for r in source.someSelectedRows: r.y += (r.y >= cursorBox.y1)', '')
-Drawing.addCommand('zi', 'insert-col', 'for r in source.someSelectedRows: r.x += (r.x >= cursorBox.x1)', '')
+Drawing.addCommand('i', 'insert-row', 'with transaction() as tx:\n    for r in source.someSelectedRows:\n        if r.y >= cursorBox.y1: tx.set(r, "y", r.y+1)', '')
+Drawing.addCommand('zi', 'insert-col', 'with transaction() as tx:\n    for r in source.someSelectedRows:\n        if r.x >= cursorBox.x1: tx.set(r, "x", r.x+1)', '')
 
 Drawing.addCommand('zm', 'place-mark', 'sheet.mark=(cursorBox.x1, cursorBox.y1)')
 Drawing.addCommand('m', 'swap-mark', '(cursorBox.x1, cursorBox.y1), sheet.mark=sheet.mark, (cursorBox.x1, cursorBox.y1)')
@@ -0,0 +1,123 @@
+import os
+import time
+
+from visidata import vd, VisiData, BaseSheet, Sheet, AttrColumn, colors, clipdraw, date
+
+from .drawing import Drawing, DrawingSheet
+
+vd.option('ddw_drawstats', False, 'record counts and timings of each draw and save, shown in an overlay and in the DrawStats sheet')
+vd.option('ddw_drawstats_history', 1000, 'number of draws and saves to keep in the DrawStats sheet')
+
+
+class DrawStats:
+    'Counts and phase timings of one draw or save.'
+    visited = culled = drawn = cells = clipdraw = frames = bytes = 0
+    composite_ms = overlay_ms = status_ms = total_ms = 0.0
+
+    def __init__(self, sheet, what):
+        self.time = time.time()
+        self.sheet = sheet.name
+        self.what = what
+        self.t0 = self.tlast = time.perf_counter()
+
+    def lap(self, phase):
+        'Add time since last lap to *phase*.'
+        now = time.perf_counter()
+        setattr(self, phase+'_ms', getattr(self, phase+'_ms') + (now-self.tlast)*1000)
+        self.tlast = now
+
+    def count(self, **kwargs):
+        for k, n in kwargs.items():
+            setattr(self, k, getattr(self, k) + n)
+
+    def finish(self):
+        self.total_ms = (time.perf_counter()-self.t0)*1000
+        hist = vd.drawstats
+        hist.append(self)
+        del hist[:-max(1, vd.options.ddw_drawstats_history)]
+
+
+@VisiData.lazy_property
+def drawstats(vd):
+    return []  # DrawStats of each draw and save, oldest first
+
+
+class DrawStatsSheet(Sheet):
+    rowtype = 'draws'  # rowdef: DrawStats
+    columns = [
+        AttrColumn('time', type=date, fmtstr='%Y-%m-%d %H:%M:%S'),
+        AttrColumn('sheet'),
+        AttrColumn('what'),
+        AttrColumn('total_ms', type=float),
+        AttrColumn('composite_ms', type=float),
+        AttrColumn('overlay_ms', type=float),
+        AttrColumn('status_ms', type=float),
+        AttrColumn('visited', type=int),
+        AttrColumn('culled', type=int),
+        AttrColumn('drawn', type=int),
+        AttrColumn('cells', type=int),
+        AttrColumn('clipdraw', type=int),
+        AttrColumn('frames', type=int),
+        AttrColumn('bytes', type=int),
+    ]
+    def iterload(self):
+        yield from vd.drawstats
+
+
+@Drawing.around
+def draw(sheet, func, scr):
+    if not sheet.options.ddw_drawstats:
+        sheet.drawstats = None
+        return func(sheet, scr)
+
+    stats = sheet.drawstats = DrawStats(sheet, 'draw')
+    try:
+        return func(sheet, scr)
+    finally:
+        stats.finish()
+        sheet.draw_drawstats(scr, stats)
+
+
+@Drawing.api
+def draw_drawstats(sheet, scr, stats):
+    'Draw overlay of *stats* in the lower right corner of the canvas.'
+    lines = [f'draw {stats.total_ms:6.1f}ms  composite {stats.composite_ms:5.1f}  overlay {stats.overlay_ms:4.1f}  status {stats.status_ms:4.1f}',
+             f'visited {stats.visited}  culled {stats.culled}  drawn {stats.drawn}  cells {stats.cells}  clipdraw {stats.clipdraw}']
+    w = max(len(s) for s in lines)+2
+    for i, s in enumerate(lines):
+        clipdraw(scr, sheet.windowHeight-2-len(lines)+i, sheet.windowWidth-w-1, ' '+s, colors.color_menu, w=w)
+
+
+def saver_stats(what):
+    'Return around-wrapper for save_*(p, *sheets) that records a DrawStats of each save if options.ddw_drawstats.'
+    def save(obj, func, p, *sheets):
+        if not sheets or not sheets[0].options.ddw_drawstats:
+            return func(obj, p, *sheets)
+
+        stats = DrawStats(sheets[0], what)
+        stats.frames = sum(max(1, len(vs.frames)) for vs in sheets if isinstance(vs, (Drawing, DrawingSheet)))
+        try:
+            return func(obj, p, *sheets)
+        finally:
+            if os.path.exists(str(p)):
+                stats.bytes = os.path.getsize(str(p))
+            stats.finish()
+    save.__name__ = what
+    return save
+
+
+DrawingSheet.around(saver_stats('save_txt'))
+for what in 'save_ans save_ansihtml save_png save_gif'.split():
+    VisiData.around(saver_stats(what))
+
+
+vd.addGlobals(DrawStatsSheet=DrawStatsSheet)
+
+Drawing.addCommand('zv', 'toggle-drawstats', 'vd.options.ddw_drawstats = not vd.options.ddw_drawstats', 'toggle overlay of counts and timings of each draw')
+BaseSheet.addCommand('', 'open-drawstats', 'vd.push(DrawStatsSheet("drawstats"))', 'open sheet of counts and timings of recent draws and saves')
+Drawing.bindkey('gzv', 'open-drawstats')
+
+vd.addMenuItems('''
+    DarkDraw > View > Draw stats > open-drawstats
+    DarkDraw > Toggle draw stats > toggle-drawstats
+''')
@@ -26,32 +26,32 @@ _VERT_MIRROR_MAP = {**{_UPPER_XY[i]: _LOWER_XY[i] for i in range(len(_UPPER_XY))
 
 @Drawing.api
 def flip_horiz(sheet, box, rows):
-    for r in rows:
-        vd.addUndo(setattr, r, 'x', r.x)
-        r.x = box.x2+box.x1-r.x-2
+    with sheet.transaction() as tx:
+        for r in rows:
+            tx.set(r, 'x', box.x2+box.x1-r.x-2)
 
 
 @Drawing.api
 def flip_vert(sheet, box, rows):
-    for r in rows:
-        vd.addUndo(setattr, r, 'y', r.y)
-        r.y = box.y2+box.y1-r.y-2
+    with sheet.transaction() as tx:
+        for r in rows:
+            tx.set(r, 'y', box.y2+box.y1-r.y-2)
 
 
 @Drawing.api
 def mirror_horiz(sheet, rows):
-    for r in rows:
-        if r.text and r.text in _HORIZ_MIRROR_MAP:
-            vd.addUndo(setattr, r, 'text', r.text)
-            r.text = _HORIZ_MIRROR_MAP[r.text]
+    with sheet.transaction() as tx:
+        for r in rows:
+            if r.text and r.text in _HORIZ_MIRROR_MAP:
+                tx.set(r, 'text', _HORIZ_MIRROR_MAP[r.text])
 
 
 @Drawing.api
 def mirror_vert(sheet, rows):
-    for r in rows:
-        if r.text and r.text in _VERT_MIRROR_MAP:
-            vd.addUndo(setattr, r, 'text', r.text)
-            r.text = _VERT_MIRROR_MAP[r.text]
+    with sheet.transaction() as tx:
+        for r in rows:
+            if r.text and r.text in _VERT_MIRROR_MAP:
+                tx.set(r, 'text', _VERT_MIRROR_MAP[r.text])
 
 
 Drawing.addCommand('', 'flip-cursor-horiz', 'flip_horiz(cursorBox, cursorRows)', 'Flip elements under cursor horizontally')
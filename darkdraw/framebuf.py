@@ -0,0 +1,251 @@
+from array import array
+
+from visidata import dispwidth, colors
+
+
+WIDE = 1  # left half of a double-width glyph
+CONT = 2  # right half of a double-width glyph; no glyph of its own
+
+
+class Palette:
+    'Interned color strings; cells store a color as its small integer index.  0 is the default color "".'
+    def __init__(self):
+        self.colors = ['']
+        self.ids = {'': 0}
+
+    def intern(self, color):
+        i = self.ids.get(color)
+        if i is None:
+            i = self.ids[color] = len(self.colors)
+            self.colors.append(color)
+        return i
+
+    def __getitem__(self, i):
+        return self.colors[i]
+
+    def __len__(self):
+        return len(self.colors)
+
+
+palette = Palette()  # shared by all FrameBuffers, so color indexes compare across frames
+
+
+class ColorAttrs:
+    'Curses attrs for each palette color: plain, under the cursor, selected, and both.  Forgotten when any color option changes, as by a theme.'
+    def __init__(self):
+        self.key = None
+        self.cursor = self.selected = ''  # color_current_row and color_selected_row
+        self.attrs = {}  # palette index -> (plain, cursor, selected, cursor+selected)
+
+    def refresh(self, options):
+        'Drop cached attrs if any color option has changed since last time; return self.'
+        key = tuple((k, getattr(options, k)) for k in options.keys() if k.startswith('color_'))
+        if key != self.key:
+            self.key = key
+            self.cursor, self.selected = options.color_current_row, options.color_selected_row
+            self.attrs = {}
+        return self
+
+    def get(self, color, cursor=False, selected=False):
+        'Return curses attr for element *color* (a string), with the cursor and/or selected colors on top.'
+        i = palette.intern(color)
+        variants = self.attrs.get(i)
+        if variants is None:
+            cur, sel = self.cursor, self.selected
+            variants = self.attrs[i] = (colors[color],
+                                        colors[cur + ' ' + color],
+                                        colors[sel + ' ' + color],
+                                        colors[sel + ' ' + cur + ' ' + color])
+        return variants[cursor + 2*selected]
+
+
+colorattrs = ColorAttrs()
+
+
+class FrameBuffer:
+    'Composited cells of one frame over the box (x1,y1)-(x2,y2): topmost glyph and color per cell, in flat row-major arrays.  Wide glyphs are followed by a continuation cell with glyph "".'
+    def __init__(self, x1=0, y1=0, x2=-1, y2=-1):
+        self.x1, self.y1 = x1, y1
+        self.w, self.h = max(0, x2-x1+1), max(0, y2-y1+1)
+        n = self.w*self.h
+        self.chars = array('I', [0])*n   # codepoint of glyph, 0 if empty
+        self.colors = array('I', [0])*n  # index into palette
+        self.flags = array('B', [0])*n   # WIDE or CONT
+        self.combined = {}  # cell index -> glyph with combining chars, for the rare glyph that is more than one codepoint
+        self._runs = {}   # y -> [(x, [glyph, ...], color), ...]; computed on demand
+        self._delta = None  # (prev FrameBuffer, delta from prev), for the last delta() asked for
+
+    def __bool__(self):
+        return self.w*self.h > 0
+
+    @property
+    def bounds(self):
+        'Return (xmin, ymin, xmax, ymax) of the box (inclusive).'
+        if not self:
+            return 0, 0, 0, 0
+        return self.x1, self.y1, self.x1+self.w-1, self.y1+self.h-1
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize*len(a) for a in (self.chars, self.colors, self.flags))
+
+    def _index(self, x, y):
+        x -= self.x1
+        y -= self.y1
+        if 0 <= x < self.w and 0 <= y < self.h:
+            return y*self.w + x
+        return None
+
+    def _glyph(self, i):
+        if self.flags[i] == CONT:
+            return ''
+        return self.combined.get(i) or chr(self.chars[i])
+
+    def get(self, x, y):
+        'Return (glyph, color) at (*x*,*y*), or None if empty.'
+        i = self._index(x, y)
+        if i is None or not self.chars[i]:
+            return None
+        return self._glyph(i), palette[self.colors[i]]
+
+    def _set(self, i, ch, color, flag):
+        'Set cell *i* to codepoint *ch* with *color* index, breaking up any wide glyph it overlaps.'
+        old = self.flags[i]
+        if old == CONT and flag != CONT:  # overwriting right half of wide glyph, other than with the right half of the one just written
+            self.chars[i-1] = 32
+            self.flags[i-1] = 0
+            self.combined.pop(i-1, None)
+        elif old == WIDE and flag != WIDE:  # overwriting left half
+            self.chars[i+1] = 32
+            self.flags[i+1] = 0
+        self.chars[i] = ch
+        self.colors[i] = color
+        self.flags[i] = flag
+        self.combined.pop(i, None)
+
+    def draw_text(self, x, y, text, color):
+        'Composite *text* with *color* at (*x*,*y*), over what is already there.  Cells outside the box are dropped.'
+        c = palette.intern(color)
+        self._runs.pop(y, None)
+        self._delta = None
+        last = None
+        for ch in text:
+            w = dispwidth(ch)
+            if w <= 0:  # combining char
+                if last is not None:
+                    self.combined[last] = self._glyph(last) + ch
+                continue
+            i = self._index(x, y)
+            j = self._index(x+1, y) if w > 1 else None
+            if i is not None:
+                self._set(i, ord(ch), c, WIDE if j is not None else 0)
+                last = i
+            if j is not None:
+                self._set(j, 32, c, CONT)
+            x += w
+
+    def cells(self, y):
+        'Generate (x, glyph, color) for each cell on line *y* in the box; glyph is None if empty, "" if right half of wide glyph.'
+        i = self._index(self.x1, y)
+        if i is None:
+            return
+        chars, colors = self.chars, self.colors
+        for x in range(self.x1, self.x1+self.w):
+            yield x, (self._glyph(i) if chars[i] else None), palette[colors[i]]
+            i += 1
+
+    def text(self, y, x1, x2):
+        'Return glyphs on line *y* for x1 <= x < x2, with " " for empty cells.'
+        return ''.join(cell[0] if cell else ' ' for cell in (self.get(x, y) for x in range(x1, x2)))
+
+    def runs(self, y):
+        'Return list of (x, glyphs, color) runs of adjacent cells with the same color on line *y*.'
+        if y not in self._runs:
+            ret = []
+            i = self._index(self.x1, y)
+            if i is not None:
+                chars, colors = self.chars, self.colors
+                rcolor = None
+                for x in range(self.x1, self.x1+self.w):
+                    if not chars[i]:
+                        rcolor = None
+                    elif colors[i] == rcolor:
+                        ret[-1][1].append(self._glyph(i))
+                    else:
+                        rcolor = colors[i]
+                        ret.append((x, [self._glyph(i)], rcolor))
+                    i += 1
+            self._runs[y] = [(x, glyphs, palette[c]) for x, glyphs, c in ret]
+        return self._runs[y]
+
+    def iterruns(self, y, x1, x2):
+        'Generate (x, text, color) for runs on line *y* clipped to x1 <= x < x2.'
+        for x, glyphs, color in self.runs(y):
+            clipped = clip(x, glyphs, x1, x2)
+            if clipped:
+                yield clipped + (color,)
+
+    def _sameline(self, prev, y):
+        'Return True if line *y* is identical in *prev*, which has the same box.'
+        if self.combined or prev.combined:
+            return False
+        i = self._index(self.x1, y)
+        j = i+self.w
+        return (self.chars[i:j] == prev.chars[i:j] and
+                self.colors[i:j] == prev.colors[i:j] and
+                self.flags[i:j] == prev.flags[i:j])
+
+    def delta(self, prev):
+        'Return list of (y, x, glyphs, color) runs of cells that differ from FrameBuffer *prev*, to turn it into this one.  Cells empty here are " " with color "".  Cached per *prev*.'
+        if self._delta and self._delta[0] is prev:
+            return self._delta[1]
+
+        same = self.bounds == prev.bounds
+        bufs = [b for b in (self, prev) if b]
+        ret = []
+        if bufs:
+            x1 = min(b.x1 for b in bufs)
+            x2 = max(b.x1+b.w for b in bufs)
+            for y in range(min(b.y1 for b in bufs), max(b.y1+b.h for b in bufs)):
+                if same and self._sameline(prev, y):
+                    continue
+
+                run = None
+                for x in range(x1, x2):
+                    cell = self.get(x, y) or (' ', '')
+                    if cell == (prev.get(x, y) or (' ', '')):
+                        run = None
+                        continue
+                    glyph, color = cell
+                    if run and run[3] == color:
+                        run[2].append(glyph)
+                    else:
+                        run = (y, x, [glyph], color)
+                        ret.append(run)
+
+        self._delta = (prev, ret)
+        return ret
+
+
+def clip(x, glyphs, x1, x2):
+    'Return (x, text) of the part of the run of *glyphs* at *x* with x1 <= x < x2, or None if none of it is.'
+    if x >= x2 or x+len(glyphs) <= x1:
+        return None
+    a, b = max(0, x1-x), min(len(glyphs), x2-x)
+    text = ''.join(g or (' ' if i == a else '') for i, g in enumerate(glyphs[a:b], start=a))
+    return x+a, text
+
+
+def composite(placements, visible=lambda p: True):
+    'Return FrameBuffer of Placements drawn in order, later on top, sized to fit them.'
+    placements = [p for p in placements if p.row.text and visible(p)]
+    if not placements:
+        return FrameBuffer()
+
+    buf = FrameBuffer(min(p.x for p in placements),
+                      min(p.y for p in placements),
+                      max(p.x+max(1, dispwidth(p.row.text))-1 for p in placements),
+                      max(p.y for p in placements))
+    for p in placements:
+        buf.draw_text(p.x, p.y, p.row.text, p.row.color or '')
+    return buf
@@ -1,89 +1,180 @@
+import concurrent.futures
+import functools
+import os
+import pickle
 from pathlib import Path
-from unittest import mock
 
-from visidata import VisiData, colors, vd
+from visidata import VisiData, AttrDict, colors, vd, dispwidth
 
 from .drawing import Drawing, DrawingSheet
 from .ansihtml import xterm256_to_rgb
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 
 vd.option('darkdraw_font', '/usr/share/fonts/opentype/unifont/unifont.otf', 'path of font file for save_png')
 vd.option('darkdraw_font_size', 16, 'font size for save_png')
+vd.option('darkdraw_export_workers', 1, 'number of processes rendering frames for save_png/save_gif (0 for one per cpu); at most one per 50000 elements in all frames, as smaller exports are faster in this process')
 
+WORKER_MIN_ELEMENTS = 50000  # per worker process; below this, starting it and pickling rows and images costs more than rendering in parallel saves
 
-@Drawing.api
-def createPillowImage(dwg):
-    im = Image.new("RGB", (640, 480), color=(0,0,0))
 
-    draw = ImageDraw.Draw(im)
-    font = None
-    if Path(dwg.options.darkdraw_font).exists():
-        font = ImageFont.truetype(dwg.options.darkdraw_font, dwg.options.darkdraw_font_size)
-    else:
-        vd.warning(f"{dwg.options.darkdraw_font} does not exist")
-
-    vd.clearCaches()
-    dwg._scr = mock.MagicMock(__bool__=mock.Mock(return_value=True),
-                              getmaxyx=mock.Mock(return_value=(9999, 9999)))
-    dwg.draw(dwg._scr)
-
-    displayed = set()
-    minX, minY = dwg.minXY
-    maxX, maxY = dwg.maxXY
-    for y in range(minY, maxY+1):
-        for x in range(minX, maxX+1):
-            rows = dwg._displayedRows.get((x,y), None)
-            if not rows: continue
-            r = rows[-1]
-            k = str(r)
-            if k in displayed: continue
-            if not r.text: continue
-            if x-r.x >= len(r.text): continue
-            i = x-r.x
-            s = r.text[i:]
-            fg, bg, attrs = colors._split_colorstr(r.color)
+@functools.lru_cache(maxsize=None)
+def load_font(path, size):
+    'Return ImageFont loaded from *path*, or None if it does not exist.  Loaded once per path and size.'
+    if Path(path).exists():
+        return ImageFont.truetype(path, size)
+    vd.warning(f"{path} does not exist")
+
+
+def cell_size(font, fontsize):
+    'Return (width, height) in pixels of a character cell of *font*: the advance of a half-width glyph, and ascent plus descent.  Without a font, half of *fontsize* wide and *fontsize* high.'
+    if font is None:
+        return max(1, fontsize//2), fontsize
+    ascent, descent = font.getmetrics()
+    return max(1, round(font.getlength('M'))), ascent+descent
+
+
+class GlyphAtlas:
+    'Tiles of each (glyph, color) cell, rasterized once and pasted wherever that cell appears.'
+    def __init__(self, font, fontsize=16):
+        self.font = font
+        self.cellw, self.cellh = cell_size(font, fontsize)
+        self.tiles = {}  # (glyph, color) -> Image
+
+    def tile(self, glyph, color):
+        im = self.tiles.get((glyph, color))
+        if im is None:
+            fg, bg, attrs = colors._split_colorstr(color)
             c = xterm256_to_rgb(fg)
-            xy = ((r.x+i)*8, r.y*16)
-            if bg:
-                draw.rectangle((xy, (xy[0]+16, xy[1]+8)), fill=xterm256_to_rgb(bg))
-            draw.text(xy, s, font=font, fill=c)
+            w = self.cellw*max(1, dispwidth(glyph))
+            im = Image.new("RGB", (w, self.cellh), color=xterm256_to_rgb(bg) if bg else (0,0,0))
+            draw = ImageDraw.Draw(im)
+            draw.text((0, 0), glyph, font=self.font, fill=c)
             if 'underline' in attrs:
-                draw.line((xy, (xy[0]+16, xy[1])), fill=c)
-                draw.line(((xy[0], xy[1]+8), (xy[0]+16, xy[1]+8)), fill=c)
-            displayed.add(k)
+                draw.line(((0, self.cellh-1), (w-1, self.cellh-1)), fill=c)
+            self.tiles[(glyph, color)] = im
+        return im
+
 
-    vd.status(' '.join(displayed))
+@functools.lru_cache(maxsize=None)
+def glyph_atlas(fontpath, fontsize):
+    return GlyphAtlas(load_font(fontpath, fontsize), fontsize)
+
+
+def union_bounds(boxes):
+    'Return (xmin, ymin, xmax, ymax) covering all *boxes*.'
+    boxes = list(boxes) or [(0, 0, 0, 0)]
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+@Drawing.api
+def createPillowImage(dwg, frame=None, bounds=None):
+    'Return Pillow Image of *frame* (base only if None), covering *bounds* (default: the bounds of the frame).'
+    atlas = glyph_atlas(dwg.options.darkdraw_font, dwg.options.darkdraw_font_size)
+    grid = dwg.render_grid(frame)
+    x1, y1, x2, y2 = bounds or grid.bounds
+    cw, ch = atlas.cellw, atlas.cellh
+    im = Image.new("RGB", ((x2-x1+1)*cw, (y2-y1+1)*ch), color=(0,0,0))
+    for y in range(grid.y1, grid.y1+grid.h):
+        for x, glyph, color in grid.cells(y):
+            if glyph:
+                im.paste(atlas.tile(glyph, color), ((x-x1)*cw, (y-y1)*ch))
     return im
 
 
-@VisiData.api
-def save_png(vd, p, *sheets):
-    frames = []
+def render_images(dwg, frames):
+    'Return list of (bounds, Image) for each of *frames* (None for the base image) of *dwg*, each sized to its own bounds; (None, None) for empty frames.'
+    ret = []
+    for f in frames:
+        grid = dwg.render_grid(f)
+        ret.append((grid.bounds, dwg.createPillowImage(f)) if grid else (None, None))
+    return ret
+
+
+_snapshots = []  # Drawing per sheet being exported, in worker processes
+
+
+def load_snapshots(snapshots, options):
+    'Set up a worker process with a Drawing for each (pickled rows, disabled_tags) in *snapshots*.'
+    for k, v in options.items():
+        setattr(vd.options, k, v)
+    for rows, disabled_tags in snapshots:
+        dwg = DrawingSheet('', rows=pickle.loads(rows)).drawing
+        dwg.disabled_tags = set(disabled_tags)
+        _snapshots.append(dwg)
+
+
+def render_snapshot(sheetidx, frameidxs):
+    'Return render_images() of frames at *frameidxs* (None for the base image) of snapshot *sheetidx*.  Runs in a worker process.'
+    dwg = _snapshots[sheetidx]
+    frames = dwg.source.frames
+    return render_images(dwg, [None if i is None else frames[i] for i in frameidxs])
+
+
+def createPillowImages(sheets):
+    'Return list of Pillow Images of every frame in *sheets*, in order, all the same size.  Render in parallel across options.darkdraw_export_workers processes.'
+    jobs = []  # (dwg, [frame or None, ...]) per sheet
     for vs in sheets:
-        dwg = vs.drawing
-        im = dwg.createPillowImage()
+        jobs.append((vs.drawing, list(vs.frames) or [None]))
 
-        if vs.frames:
-            for i in range(vs.nFrames):
-                dwg.cursorFrameIndex = i
-                frames.append(dwg.createPillowImage())
+    nframes = sum(len(frames) for dwg, frames in jobs)
+    nelements = sum(dwg.source.cellIndex.nframe(f) for dwg, frames in jobs for f in frames)
+    nworkers = min(vd.options.darkdraw_export_workers or os.cpu_count() or 1, nelements//WORKER_MIN_ELEMENTS)
+    if nworkers <= 1:
+        results = [r for dwg, frames in jobs for r in render_images(dwg, frames)]
+    else:
+        # snapshot rows now, so edits during the export don't leak into it
+        snapshots = [(pickle.dumps(dwg.source.rows), list(dwg.disabled_tags)) for dwg, frames in jobs]
+        options = {k: getattr(vd.options, k) for k in ['darkdraw_font', 'darkdraw_font_size']}
+        chunksize = -(-nframes // (nworkers*4))  # a few chunks per worker to even out the load
+        with concurrent.futures.ProcessPoolExecutor(nworkers, initializer=load_snapshots, initargs=(snapshots, options)) as executor:
+            futures = []
+            for sheetidx, (dwg, frames) in enumerate(jobs):
+                idxs = [None if f is None else i for i, f in enumerate(frames)]
+                for i in range(0, len(idxs), chunksize):
+                    futures.append(executor.submit(render_snapshot, sheetidx, idxs[i:i+chunksize]))
+            results = [r for fut in futures for r in fut.result()]
+
+    # paste each image into the same bounds
+    atlas = glyph_atlas(vd.options.darkdraw_font, vd.options.darkdraw_font_size)
+    x1, y1, x2, y2 = bounds = union_bounds(b for b, im in results if b)
+    ims = []
+    for b, im in results:
+        if b != bounds:
+            canvas = Image.new("RGB", ((x2-x1+1)*atlas.cellw, (y2-y1+1)*atlas.cellh), color=(0,0,0))
+            if im:
+                canvas.paste(im, ((b[0]-x1)*atlas.cellw, (b[1]-y1)*atlas.cellh))
+            im = canvas
+        ims.append(im)
+    return ims
+
+
+def frame_durations(sheets):
+    'Return list of duration in ms of every frame in *sheets*, in the same order as createPillowImages.'
+    return [(f.duration_ms or 100) for vs in sheets for f in (vs.frames or [AttrDict()])]
+
+
+def merge_frames(ims, durations):
+    'Return (ims, durations) with identical consecutive images merged into one, for the sum of their durations.'
+    retims, retdurs = [], []
+    for im, ms in zip(ims, durations):
+        if retims and ImageChops.difference(retims[-1], im).getbbox() is None:
+            retdurs[-1] += ms
         else:
-            frames.append(dwg.createPillowImage())
+            retims.append(im)
+            retdurs.append(ms)
+    return retims, retdurs
+
 
-    frames[0].save(str(p), append_images=frames[1:], save_all=True, duration=100, loop=0)
+@VisiData.api
+def save_png(vd, p, *sheets):
+    frames, durations = merge_frames(createPillowImages(sheets), frame_durations(sheets))
+    frames[0].save(str(p), append_images=frames[1:], save_all=True, duration=durations, loop=0)
 
 
 @VisiData.api
 def save_gif(vd, p, *sheets):
-    frames = []
-    for vs in sheets:
-        dwg = vs.drawing
-        if vs.frames:
-            for i in range(vs.nFrames):
-                dwg.cursorFrameIndex = i
-                frames.append(dwg.createPillowImage())
-        else:
-            frames.append(dwg.createPillowImage())
-
-    frames[0].save(str(p), append_images=frames[1:], optimize=False, save_all=True, duration=100, loop=0)
+    frames = createPillowImages(sheets)
+    # with disposal=1 each frame stays in place, so Pillow (>= 9) crops each frame to the rectangle that changed from the previous one, and merges identical frames
+    frames[0].save(str(p), append_images=frames[1:], optimize=False, save_all=True, duration=frame_durations(sheets), disposal=1, loop=0)
@@ -1,5 +1,16 @@
+import functools
+import re
+import sys
+import time
+
 from visidata import vd, VisiData
 
+from .drawing import Drawing
+from .framebuf import clip
+
+vd.option('darkdraw_ans_animate', True, 'save_ans saves drawings with frames as an animation, instead of the current frame only')
+vd.option('darkdraw_ans_sleep', True, 'put sleep markers between frames of animated save_ans, for play() in darkdraw/save_ans.py to replay')
+
 # Color names mapping to 256-color codes
 color_names = {
     'black': 0, 'red': 1, 'green': 2, 'yellow': 3,
@@ -71,80 +82,122 @@ def get_escape_codes(attributes, fg, bg):
 
     return '\033[' + ';'.join(codes) + 'm' if codes else ''
 
-def export_frame(rows, x_col, y_col, text_col, color_col):
-    """Export a single frame to ANSI text."""
-    if not rows:
-        return ''
-
-    # Find max_x and max_y
-    max_x = 0
-    max_y = 0
-    for row in rows:
-        x = int(x_col.getValue(row))
-        y = int(y_col.getValue(row))
-        text = str(text_col.getValue(row))
-        max_x = max(max_x, x + len(text) - 1)
-        max_y = max(max_y, y)
-
-    # Create grid
-    grid = [[None] * (max_x + 1) for _ in range(max_y + 1)]
-
-    # Place characters
-    for row in rows:
-        x = int(x_col.getValue(row))
-        y = int(y_col.getValue(row))
-        text = str(text_col.getValue(row))
-        color_str = str(color_col.getValue(row))
-        attributes, fg, bg = parse_color(color_str)
-        for i, char in enumerate(text):
-            grid[y][x + i] = (char, attributes, fg, bg)
-
-    # Generate output
-    output = ''
-    for y in range(max_y + 1):
-        line = ''
-        for x in range(max_x + 1):
-            cell = grid[y][x]
-            if cell:
-                char, attributes, fg, bg = cell
-                codes = get_escape_codes(attributes, fg, bg)
-                line += codes + char + '\033[0m'
-            else:
-                line += ' '
-        output += line + '\n'
-    return output
+RESET = '\033[0m'
+
+@functools.lru_cache(maxsize=None)
+def get_sgr(color_str):
+    """Return escape sequence switching to color_str from whatever attributes were in effect, parsed once per color string."""
+    return get_escape_codes(*parse_color(color_str)).replace('\033[', '\033[0;', 1)
+
+def iterlines(grid):
+    """Generate lines of ANSI text for a FrameBuffer from Drawing.render_grid, starting at (0,0).  SGR codes are emitted only where the color changes."""
+    if not grid:
+        return
+
+    for y in range(grid.y1 + grid.h):
+        parts = []
+        current = ''   # SGR in effect
+        blanks = max(0, grid.x1)  # pending empty cells
+        for x, char, color_str in grid.cells(y):
+            if x < 0 or char == '':  # offscreen, or right half of wide char
+                continue
+            if char is None:
+                blanks += 1
+                continue
+            if blanks:
+                if current:
+                    parts.append(RESET)
+                    current = ''
+                parts.append(' ' * blanks)
+                blanks = 0
+            sgr = get_sgr(color_str)
+            if sgr != current:
+                parts.append(sgr)
+                current = sgr
+            parts.append(char)
+        if current:
+            parts.append(RESET)
+        parts.append('\n')
+        yield ''.join(parts)
+
+def export_frame(grid):
+    """Export a single frame rendered by Drawing.render_grid to ANSI text."""
+    return ''.join(iterlines(grid))
+
+def sleep_marker(ms):
+    """Return marker telling a player to wait ms milliseconds; an APC string, which terminals ignore."""
+    return f'\033_sleep {ms}\033\\'
+
+def iterdelta(grid, prev):
+    """Return ANSI text to turn FrameBuffer prev on screen into grid: cursor-positioned runs of the changed cells, or the whole frame if that is shorter."""
+    parts = []
+    cx = cy = None  # cursor position
+    current = None  # SGR in effect
+    for y, x, glyphs, color_str in grid.delta(prev):
+        clipped = clip(x, glyphs, 0, x + len(glyphs))
+        if y < 0 or not clipped:
+            continue
+        end = x + len(glyphs)
+        x, text = clipped
+        if (x, y) != (cx, cy):
+            parts.append(f'\033[{y+1};{x+1}H')
+        sgr = get_sgr(color_str)
+        if sgr != current:
+            parts.append(sgr)
+            current = sgr
+        parts.append(text)
+        cx, cy = end, y
+    if current:
+        parts.append(RESET)
+    delta = ''.join(parts)
+
+    full = '\033[H' + ''.join(line[:-1] + '\033[K\n' for line in iterlines(grid)) + '\033[J'
+    return min(delta, full, key=len)
+
+def iteranimation(grids, durations, sleep=True):
+    """Generate ANSI text that draws the first FrameBuffer in full, then only the cells that change in each following one.  If sleep, put a sleep_marker with each frame's duration after it."""
+    yield '\033[2J\033[H'  # clear screen, cursor home
+    yield from iterlines(grids[0])
+    for prev, grid, ms in zip(grids, grids[1:], durations):
+        if sleep:
+            yield sleep_marker(ms)
+        yield iterdelta(grid, prev)
+
+    if sleep:
+        yield sleep_marker(durations[-1])
+    bottom = max(g.y1 + g.h for g in grids)
+    yield f'\033[{bottom+1};1H'
+
+def play(fp, out=sys.stdout):
+    """Replay ANSI text from fp to out, waiting at each sleep_marker."""
+    for i, chunk in enumerate(re.split(r'\033_sleep (\d+)\033\\', fp.read())):
+        if i % 2:
+            out.flush()
+            time.sleep(int(chunk)/1000)
+        else:
+            out.write(chunk)
+    out.flush()
 
 @VisiData.api
 def save_ans(vd, p, sheet):
-    """Save the current sheet as an ANSI text file, exporting only rows with empty frame and type."""
-    required_columns = ['x', 'y', 'text', 'color']
-    columns_dict = {col.name: col for col in sheet.columns}
-    for col_name in required_columns:
-        if col_name not in columns_dict:
-            vd.fail(f'Missing column: {col_name}')
-
-    x_col = columns_dict['x']
-    y_col = columns_dict['y']
-    text_col = columns_dict['text']
-    color_col = columns_dict['color']
-    frame_col = columns_dict.get('frame', None)
-    type_col = columns_dict.get('type', None)
-
-    # Filter rows where both frame and type are empty
-    filtered_rows = []
-    for row in sheet.rows:
-        frame_value = frame_col.getValue(row) if frame_col else None
-        type_value = type_col.getValue(row) if type_col else None
-        # Consider a value empty if it is None or an empty string
-        if (frame_value is None or frame_value == '') and (type_value is None or type_value == ''):
-            filtered_rows.append(row)
-
-    if not filtered_rows:
-        vd.fail('Drawing is animation; cannot export as ANSI.')
-
-    # Export filtered rows as a single frame
-    output = export_frame(filtered_rows, x_col, y_col, text_col, color_col)
+    """Save the drawing as an ANSI text file, one line at a time.  Drawings with frames are saved as an animation, unless options.darkdraw_ans_animate is False, in which case only the current frame is saved."""
+    dwg = sheet if isinstance(sheet, Drawing) else sheet.drawing
+    frames = dwg.source.frames
+    if frames and sheet.options.darkdraw_ans_animate:
+        grids = [dwg.render_grid(f) for f in frames]
+        durations = [(f.duration_ms or 100) for f in frames]
+        with open(p, 'w') as fp:
+            for s in iteranimation(grids, durations, sleep=sheet.options.darkdraw_ans_sleep):
+                fp.write(s)
+        vd.status(f'Saved {len(frames)} frames to {p}')
+        return
+
+    grid = dwg.render_grid(dwg.currentFrame)
+    if not grid:
+        vd.fail('nothing to save in current frame')
 
     with open(p, 'w') as f:
-        f.write(output)
-    vd.status(f'Saved {len(filtered_rows)} rows to {p}')
+        for line in iterlines(grid):
+            f.write(line)
+    vd.status(f'Saved {grid.w}x{grid.h} cells to {p}')
+
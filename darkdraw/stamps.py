@@ -22,9 +22,11 @@ def stamp_circle(sheet, box):
         coords.add((int(x+(xr*math.cos(theta))), int(y+(yr*math.sin(theta)))))
 
     itchars = itertools.cycle([(r.text, r.color) for r in vd.memory.cliprows or []] or [('*', '')])
+    rows = []
     for coord in coords:
         ch, color = next(itchars)
-        sheet.place_text(ch, CharBox(x1=coord[0], y1=coord[1]), go_forward=False)
+        rows.append(sheet.text_row(ch, coord[0], coord[1], vd.default_color))
+    sheet.source.addRows(rows)
 
 
 Drawing.addCommand('', 'stamp-circle', 'sheet.stamp_circle(cursorBox); # sheet.go_forward(cursorBox.w, 0)')
@@ -69,8 +69,7 @@ def run_typing_mode(ddw, scr):
         elif ch == 'KEY_BACKSPACE':
             x -= last_dispwidth
             if (x,y) in cur_edits:
-                ddw.rows.remove(cur_edits[(x,y)])
-                del cur_edits[(x,y)]
+                ddw.source.deleteRows([cur_edits.pop((x,y))])
 
         elif ch == '^P':
             ddw.keymap_layers = rotate(ddw.keymap_layers, -1)
@@ -85,7 +84,7 @@ def run_typing_mode(ddw, scr):
             else:
                 s = poss.get(layer, ch)
             if (x,y) in cur_edits:
-                ddw.rows.remove(cur_edits[(x,y)])
+                ddw.source.deleteRows([cur_edits[(x,y)]])
             cur_edits[(x,y)] = ddw.add_text(s, x, y, vd.default_color)
             last_dispwidth = dispwidth(s)
             x += last_dispwidth
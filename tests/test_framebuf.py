@@ -0,0 +1,27 @@
+from darkdraw.framebuf import FrameBuffer, WIDE, CONT
+
+
+def test_wide_over_aligned_wide():
+    buf = FrameBuffer(0, 0, 3, 0)
+    buf.draw_text(0, 0, '日', 'red')
+    buf.draw_text(0, 0, '本', 'blue')
+    assert buf.get(0, 0) == ('本', 'blue')
+    assert buf.get(1, 0) == ('', 'blue')
+    assert list(buf.flags) == [WIDE, CONT, 0, 0]
+    assert buf.text(0, 0, 4) == '本  '
+
+
+def test_wide_over_offset_wide():
+    buf = FrameBuffer(0, 0, 3, 0)
+    buf.draw_text(0, 0, '日', 'red')
+    buf.draw_text(1, 0, '本', 'blue')
+    assert buf.get(0, 0) == (' ', 'red')
+    assert buf.get(1, 0) == ('本', 'blue')
+    assert list(buf.flags) == [0, WIDE, CONT, 0]
+
+    buf = FrameBuffer(0, 0, 3, 0)
+    buf.draw_text(1, 0, '日', 'red')
+    buf.draw_text(0, 0, '本', 'blue')
+    assert buf.get(0, 0) == ('本', 'blue')
+    assert buf.get(2, 0) == (' ', 'red')
+    assert list(buf.flags) == [WIDE, CONT, 0, 0]
@@ -0,0 +1,35 @@
+from pathlib import Path
+
+from PIL import ImageFont
+from visidata import vd, AttrDict
+
+from darkdraw import DrawingSheet
+from darkdraw.save import GlyphAtlas
+
+VGA9 = str(Path(__file__).parent.parent/'pxplus_ibm_vga9-webfont.woff')  # 9x16 cells at size 16
+
+
+def test_cell_size_from_font():
+    for size in (16, 32):
+        atlas = GlyphAtlas(ImageFont.truetype(VGA9, size), size)
+        assert (atlas.cellw, atlas.cellh) == (9*size//16, size)
+        assert atlas.tile('A', '').size == (atlas.cellw, atlas.cellh)
+        assert atlas.tile('日', '').size == (2*atlas.cellw, atlas.cellh)
+
+
+def test_cell_size_without_font():
+    atlas = GlyphAtlas(None, 24)
+    assert (atlas.cellw, atlas.cellh) == (12, 24)
+
+
+def test_image_size_follows_font_size():
+    vd.options.darkdraw_font = VGA9
+    vd.options.darkdraw_font_size = 32
+    try:
+        dwg = DrawingSheet('', rows=[AttrDict(x=1, y=2, text='AB'), AttrDict(x=0, y=4, text='#')]).drawing
+        im = dwg.createPillowImage()
+        assert im.size == (3*18, 3*32)
+        assert im.getbbox()  # glyphs drawn
+    finally:
+        vd.options.unset('darkdraw_font')
+        vd.options.unset('darkdraw_font_size')